@@ -1,41 +1,192 @@
 import os
-from sqlite3 import OperationalError
-from flask import Flask, render_template, redirect, url_for, request
+import subprocess
+import sys
+import threading
+
+import click
+from flask import Flask
 from dotenv import load_dotenv
-from flask_migrate import Migrate
-from models.connection import db
 from flask_login import LoginManager
-from routes.default import app as bp_default
-from routes.auth import app as bp_auth
-from models.model import init_db
-from models.model import User
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI',"sqlite:///labo1.db")
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY',"grandepanepanegrande1212121212121212")
-
-app.register_blueprint(bp_default)
-app.register_blueprint(bp_auth, url_prefix="/auth")
-db.init_app(app)
-with app.app_context():
-     try:
-        init_db()
-     except OperationalError:
-           print("DB non ancora inizializzato, skip init_db()")
+from models.connection import db, engine_options
+from config import EVENTS, METRICS
+from utils import instrumentation, metrics
+from utils.ratelimit import limiter
 
-migrate = Migrate(app, db)
 login_manager = LoginManager()
-login_manager.login_view = 'login'
-login_manager.init_app(app)
+login_manager.login_view = 'auth.login'
+
+# importing app.py + create_app() must stay below this (milliseconds), see `flask import-time`
+IMPORT_TIME_BUDGET_MS = int(os.getenv('IMPORT_TIME_BUDGET_MS', 1500))
+
+_services_lock = threading.Lock()
+
+
+def create_app(config=None):
+    """Build the Flask app.
+
+    Nothing here touches the database or Proxmox: seeding is the `flask seed`
+    command and the background services (provisioning workers, cluster sync,
+    VMID pool, warm pool) start with start_services(), called by wsgi.py or on
+    the first request. CLI commands such as `flask db upgrade` skip both.
+    """
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI',"sqlite:///labo1.db")
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY',"grandepanepanegrande1212121212121212")
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    from routes.default import app as bp_default
+    from routes.auth import app as bp_auth
+    from routes.api import app as bp_api
+    from routes.metrics import app as bp_metrics
+    from routes.events import app as bp_events
+    app.register_blueprint(bp_default)
+    app.register_blueprint(bp_auth, url_prefix="/auth")
+    app.register_blueprint(bp_api, url_prefix="/api/v1")
+    if METRICS['enabled']:
+        app.register_blueprint(bp_metrics)
+    if EVENTS['enabled']:
+        app.register_blueprint(bp_events, url_prefix="/events")
+
+    db.init_app(app)
+    if app.config.get('ENABLE_MIGRATIONS', True):
+        # alembic is a large import that web workers don't need (wsgi.py turns it off)
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    login_manager.init_app(app)
+    instrumentation.init_app(app)
+    metrics.init_app(app)
+    limiter.init_app(app)
+    if EVENTS['enabled']:
+        from services.events import broker
+        broker.init_app(app)
+    register_commands(app)
+
+    @app.before_request
+    def _start_services():
+        start_services(app)
+
+    return app
+
+
+def start_services(app):
+    """Start the background services once per process (idempotent)."""
+    if app.extensions.get('services_started') or not app.config.get('START_SERVICES', True):
+        return
+    with _services_lock:
+        if app.extensions.get('services_started'):
+            return
+        from services.admission import admission
+        from services.clone_planner import clone_planner
+        from services.leases import leases
+        from services.lifecycle import lifecycle
+        from services.cluster_sync import cluster_sync
+        from services.provisioning import queue as provisioning
+        from services.vmid_pool import vmids
+        from services.warm_pool import warm_pool
+
+        cluster_sync.init_app(app)
+        clone_planner.init_app(app)
+        vmids.init_app(app)
+        warm_pool.init_app(app)
+        admission.init_app(app)
+        lifecycle.init_app(app)
+        leases.init_app(app)
+        provisioning.init_app(app)
+        app.extensions['services_started'] = True
+
+
+def register_commands(app):
+    @app.cli.command('seed')
+    def seed():
+        """Create the default roles and admin user (run after `flask db upgrade`)."""
+        from models.model import init_db
+        init_db()
+        click.echo('Ruoli e utente admin creati')
+
+    @app.cli.command('replicate-templates')
+    @click.option('--tier', default=None, help='only this tier (default: all)')
+    def replicate_templates(tier):
+        """Copy the cloud-init templates to every node that has none (see TEMPLATE_REPLICAS)."""
+        from services.clone_planner import clone_planner
+        created = clone_planner.ensure_replicas(tier)
+        click.echo(f'{created} template replicas created')
+
+    @app.cli.command('vm-lifecycle')
+    @click.argument('action', type=click.Choice(['start', 'shutdown', 'stop', 'destroy']))
+    @click.option('--user', default=None, help='only VMs of this username')
+    @click.option('--tier', default=None, help='only VMs of this tier')
+    @click.option('--older-than-days', type=int, default=None, help='only VMs requested more than N days ago')
+    @click.option('--yes', is_flag=True, help='do not ask for confirmation')
+    def vm_lifecycle(action, user, tier, older_than_days, yes):
+        """Start, shut down, stop or destroy every created VM matching the filters."""
+        import datetime
+        from models.connection import db
+        from services.lifecycle import lifecycle
+        if not (user or tier or older_than_days):
+            raise click.UsageError('give at least one of --user, --tier, --older-than-days')
+        older_than = datetime.timedelta(days=older_than_days) if older_than_days else None
+        vmreqs = db.session.execute(lifecycle.select(user=user, tier=tier, older_than=older_than)).scalars().all()
+        if not vmreqs:
+            click.echo('Nessuna VM corrispondente')
+            return
+        if not yes:
+            click.confirm(f'{action} {len(vmreqs)} VM?', abort=True)
+        results = lifecycle.run(action, vmreqs)
+        for req_id, error in sorted(results.items()):
+            if error:
+                click.echo(f'{req_id}: {error}')
+        click.echo(f'{sum(1 for e in results.values() if not e)}/{len(results)} VM: {action} completato')
+
+    @app.cli.command('expire-leases')
+    def expire_leases():
+        """Run one pass of the lease reaper now (stop expired VMs, destroy those past the grace period)."""
+        from services.leases import leases
+        stopped, destroyed = leases.run_once()
+        click.echo(f'{stopped} VM scadute fermate, {destroyed} distrutte')
+
+    @app.cli.command('rebuild-usage')
+    def rebuild_usage():
+        """Recompute the quota usage aggregate from vm_request (after changing VM_TYPES or roles)."""
+        from models import usage
+        from models.connection import db
+        usage.rebuild(db.session)
+        click.echo('Utilizzo risorse ricalcolato')
+
+    @app.cli.command('import-time')
+    def import_time():
+        """Measure the cost of importing app.py and building the app as a web worker does."""
+        probe = (
+            'import sys, time; t = time.perf_counter(); import app; app.create_app({"ENABLE_MIGRATIONS": False}); '
+            'print(round((time.perf_counter() - t) * 1000)); print("proxmoxer" in sys.modules)'
+        )
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe],
+                                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            raise click.ClickException(result.stderr.strip().splitlines()[-1])
+        elapsed_ms, proxmoxer_loaded = result.stdout.split()
+        # -X importtime lines: "import time: self [us] | cumulative | package"
+        rows = []
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[1].strip().isdigit():
+                rows.append((int(parts[1]), parts[2].rstrip()))
+        for cumulative, name in sorted(rows, reverse=True)[:10]:
+            click.echo(f'{cumulative / 1000:8.1f} ms {name}')
+        click.echo(f'create_app: {elapsed_ms} ms (budget {IMPORT_TIME_BUDGET_MS} ms), proxmoxer loaded: {proxmoxer_loaded}')
+        if int(elapsed_ms) > IMPORT_TIME_BUDGET_MS:
+            raise click.ClickException('import-time budget exceeded')
+
 
 @login_manager.user_loader
 def load_user(user_id):
-    # since the user_id is just the primary key of our user table, use it in the query for the user
-    stmt = db.select(User).filter_by(id=user_id)
-    user = db.session.execute(stmt).scalar_one_or_none()
-    # return User.query.get(int(user_id))   # legacy
-    return user
+    # identity and roles come from the process cache; the DB is only hit on a miss
+    # (select User by primary key with roles eager-loaded)
+    from models.user_cache import user_cache
+    return user_cache.get(user_id)
+
 
 if __name__ == "__main__":
     load_dotenv()
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
@@ -0,0 +1,332 @@
+"""Local stand-in for the Proxmox VE API, for benchmarks and manual testing.
+
+Implements the subset of /api2/json used by proxmox_api.py: ticket login,
+cluster/nextid, cluster/resources, qemu clone/create/config/start/stop/delete,
+bulk startall/stopall and task status/listing. Clones and creates complete
+after a configurable delay; any call can fail with a configurable probability.
+
+    python bench/fake_proxmox.py --port 8006 --latency 0.02 --clone-time 5
+
+then point PROXMOX['host'] at 127.0.0.1:8006 (any user/password is accepted).
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+GB = 1024 ** 3
+
+
+class FakeCluster:
+    """In-memory cluster state shared by all request handlers."""
+
+    def __init__(self, nodes=('px1', 'px2', 'px3'), latency=0.0, clone_time=2.0,
+                 failure_rate=0.0, templates=(100, 200, 300)):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.clone_time = clone_time
+        self.failure_rate = failure_rate
+        self.nodes = list(nodes)
+        self.vms = {}
+        self.tasks = {}
+        self.calls = 0
+        self._pid = itertools.count(1000)
+        for i, vmid in enumerate(templates):
+            self.vms[vmid] = {'vmid': vmid, 'node': self.nodes[i % len(self.nodes)], 'name': f'template-{vmid}',
+                              'status': 'stopped', 'template': 1, 'maxmem': 2 * GB, 'mem': 0, 'cpu': 0.0}
+
+    # -- tasks -------------------------------------------------------------
+
+    def start_task(self, node, kind, vmid, duration=0.0, on_done=None, on_fail=None):
+        now = int(time.time())
+        upid = f'UPID:{node}:{next(self._pid):08X}:00000000:{now:08X}:{kind}:{vmid}:root@pam:'
+        failed = random.random() < self.failure_rate
+        self.tasks[upid] = {'upid': upid, 'node': node, 'type': kind, 'id': str(vmid),
+                            'starttime': now, 'user': 'root@pam', 'status': 'running'}
+        if duration > 0:
+            timer = threading.Timer(duration, self._finish_locked, (upid, failed, on_done, on_fail))
+            timer.daemon = True
+            timer.start()
+        else:
+            # called from a handler, which already holds the lock
+            self._finish(upid, failed, on_done, on_fail)
+        return upid
+
+    def _finish_locked(self, upid, failed, on_done, on_fail):
+        with self.lock:
+            self._finish(upid, failed, on_done, on_fail)
+
+    def _finish(self, upid, failed, on_done, on_fail):
+        task = self.tasks[upid]
+        task['endtime'] = int(time.time())
+        task['exitstatus'] = f"{task['type']} failed: simulated error" if failed else 'OK'
+        task['status'] = 'stopped'
+        callback = on_fail if failed else on_done
+        if callback:
+            callback()
+
+    def task_list_entry(self, task):
+        entry = {k: v for k, v in task.items() if k not in ('status', 'exitstatus')}
+        if 'endtime' in task:
+            # the listing reports the exit status in "status" for finished tasks
+            entry['status'] = task['exitstatus']
+        return entry
+
+    # -- resources ---------------------------------------------------------
+
+    def resources(self, kind=None):
+        items = []
+        if kind in (None, 'node'):
+            for node in self.nodes:
+                vms = [vm for vm in self.vms.values() if vm['node'] == node and vm['status'] == 'running']
+                items.append({'type': 'node', 'node': node, 'id': f'node/{node}', 'status': 'online',
+                              'cpu': min(1.0, 0.05 * len(vms)), 'maxcpu': 32,
+                              'mem': 4 * GB + sum(vm['maxmem'] for vm in vms), 'maxmem': 128 * GB})
+        if kind in (None, 'storage'):
+            for node in self.nodes:
+                used = sum(vm.get('maxdisk', 0) for vm in self.vms.values() if vm['node'] == node)
+                items.append({'type': 'storage', 'node': node, 'storage': 'local-lvm',
+                              'id': f'storage/{node}/local-lvm', 'disk': used, 'maxdisk': 2000 * GB})
+        if kind in (None, 'vm'):
+            for vm in self.vms.values():
+                items.append({'type': 'qemu', 'id': f"qemu/{vm['vmid']}", 'netin': 0, 'netout': 0,
+                              'uptime': 0, 'maxdisk': vm.get('maxdisk', 0), **vm})
+        return items
+
+
+def make_handler(cluster):
+    routes = []
+
+    def route(method, pattern):
+        def decorator(func):
+            routes.append((method, re.compile('^/api2/json' + pattern + '$'), func))
+            return func
+        return decorator
+
+    @route('POST', '/access/ticket')
+    def ticket(params, body):
+        return {'ticket': f"PVE:{body.get('username', 'root@pam')}:FAKE", 'CSRFPreventionToken': 'fake-csrf',
+                'username': body.get('username', 'root@pam')}
+
+    @route('GET', '/cluster/nextid')
+    def nextid(params, body):
+        vmid = 100
+        while vmid in cluster.vms:
+            vmid += 1
+        return str(vmid)
+
+    @route('GET', '/cluster/resources')
+    def resources(params, body):
+        return cluster.resources(params.get('type'))
+
+    @route('POST', r'/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/clone')
+    def clone(params, body, node, vmid):
+        source = cluster.vms.get(int(vmid))
+        if source is None:
+            raise LookupError(f'VM {vmid} does not exist')
+        newid = int(body['newid'])
+        if newid in cluster.vms:
+            raise ValueError(f'VM {newid} already exists')
+        target = body.get('target', node)
+        cluster.vms[newid] = {'vmid': newid, 'node': target, 'name': body.get('name', f'vm-{newid}'),
+                              'status': 'stopped', 'lock': 'clone', 'template': 0, 'maxmem': source['maxmem'],
+                              'mem': 0, 'cpu': 0.0, 'maxdisk': 20 * GB}
+        duration = cluster.clone_time if int(body.get('full', 1)) else cluster.clone_time / 10
+
+        def done():
+            cluster.vms[newid].pop('lock', None)
+        # a failed clone leaves no VM behind
+        return cluster.start_task(node, 'qmclone', vmid, duration, done, lambda: cluster.vms.pop(newid, None))
+
+    @route('POST', r'/nodes/(?P<node>[^/]+)/qemu')
+    def create(params, body, node):
+        vmid = int(body['vmid'])
+        if vmid in cluster.vms:
+            raise ValueError(f'VM {vmid} already exists')
+        cluster.vms[vmid] = {'vmid': vmid, 'node': node, 'name': body.get('name', f'vm-{vmid}'),
+                             'status': 'stopped', 'lock': 'create', 'template': 0,
+                             'maxmem': int(body.get('memory', 2048)) * 1024 ** 2,
+                             'mem': 0, 'cpu': 0.0, 'maxdisk': 20 * GB}
+
+        def done():
+            cluster.vms[vmid].pop('lock', None)
+        return cluster.start_task(node, 'qmcreate', vmid, cluster.clone_time, done, lambda: cluster.vms.pop(vmid, None))
+
+    @route('POST', r'/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/config')
+    def config(params, body, node, vmid):
+        vm = _vm(vmid)
+        if 'name' in body:
+            vm['name'] = body['name']
+        return None
+
+    @route('POST', r'/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/template')
+    def template(params, body, node, vmid):
+        _vm(vmid)['template'] = 1
+        return None
+
+    @route('POST', r'/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/status/(?P<action>start|stop|shutdown)')
+    def power(params, body, node, vmid, action):
+        vm = _vm(vmid)
+
+        def done():
+            vm['status'] = 'running' if action == 'start' else 'stopped'
+        return cluster.start_task(node, f'qm{action}', vmid, 0, done)
+
+    @route('GET', r'/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/status/current')
+    def current(params, body, node, vmid):
+        return dict(_vm(vmid))
+
+    @route('DELETE', r'/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)')
+    def destroy(params, body, node, vmid):
+        _vm(vmid)
+
+        def done():
+            cluster.vms.pop(int(vmid), None)
+        return cluster.start_task(node, 'qmdestroy', vmid, 0, done)
+
+    @route('POST', r'/nodes/(?P<node>[^/]+)/(?P<action>startall|stopall)')
+    def bulk(params, body, node, action):
+        wanted = {int(v) for v in body.get('vms', '').split(',') if v}
+
+        def done():
+            for vm in cluster.vms.values():
+                if vm['node'] == node and not vm['template'] and (not wanted or vm['vmid'] in wanted):
+                    vm['status'] = 'running' if action == 'startall' else 'stopped'
+        return cluster.start_task(node, action, '', 0, done)
+
+    @route('GET', r'/nodes/(?P<node>[^/]+)/tasks')
+    def tasks(params, body, node):
+        since = int(params.get('since', 0))
+        source = params.get('source', 'archive')
+        limit = int(params.get('limit', 50))
+        items = [t for t in cluster.tasks.values() if t['node'] == node and t['starttime'] >= since]
+        if source == 'active':
+            items = [t for t in items if 'endtime' not in t]
+        elif source == 'archive':
+            items = [t for t in items if 'endtime' in t]
+        items.sort(key=lambda t: t['starttime'], reverse=True)
+        return [cluster.task_list_entry(t) for t in items[:limit]]
+
+    @route('GET', r'/nodes/(?P<node>[^/]+)/tasks/(?P<upid>[^/]+)/status')
+    def task_status(params, body, node, upid):
+        task = cluster.tasks.get(unquote(upid))
+        if task is None:
+            raise LookupError('no such task')
+        return dict(task)
+
+    def _vm(vmid):
+        vm = cluster.vms.get(int(vmid))
+        if vm is None:
+            raise LookupError(f'VM {vmid} does not exist')
+        return vm
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _dispatch(self, method):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length).decode() if length else ''
+            body = {k: v[-1] for k, v in parse_qs(raw).items()}
+            if cluster.latency:
+                time.sleep(cluster.latency)
+            for route_method, pattern, func in routes:
+                match = pattern.match(url.path)
+                if route_method == method and match:
+                    break
+            else:
+                return self._reply(501, {'errors': f'not implemented: {method} {url.path}'})
+            with cluster.lock:
+                cluster.calls += 1
+                try:
+                    if cluster.failure_rate and url.path != '/api2/json/access/ticket' \
+                            and random.random() < cluster.failure_rate / 4:
+                        raise RuntimeError('simulated API failure')
+                    data = func(params, body, **match.groupdict())
+                except LookupError as e:
+                    return self._reply(404, {'data': None, 'message': str(e)})
+                except Exception as e:
+                    return self._reply(500, {'data': None, 'message': str(e)})
+            self._reply(200, {'data': data})
+
+        def _reply(self, code, payload):
+            raw = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+        def do_DELETE(self):
+            self._dispatch('DELETE')
+
+    return Handler
+
+
+def self_signed_context(directory=None):
+    """TLS context with a throwaway self-signed certificate (needs the openssl CLI)."""
+    directory = directory or tempfile.mkdtemp(prefix='fake-proxmox-')
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    if not os.path.exists(cert):
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                       check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def serve(cluster, host='127.0.0.1', port=0):
+    """Start the fake API on a background thread; return (server, port)."""
+    server = ThreadingHTTPServer((host, port), make_handler(cluster))
+    server.daemon_threads = True
+    server.socket = self_signed_context().wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever, name='fake-proxmox', daemon=True)
+    thread.start()
+    return server, server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8006)
+    parser.add_argument('--nodes', default='px1,px2,px3', help='comma separated node names')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    parser.add_argument('--clone-time', type=float, default=2.0, help='seconds a full clone/create takes')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability a task fails')
+    args = parser.parse_args()
+    cluster = FakeCluster(nodes=args.nodes.split(','), latency=args.latency,
+                          clone_time=args.clone_time, failure_rate=args.failure_rate)
+    server, port = serve(cluster, args.host, args.port)
+    print(f'fake Proxmox API on https://{args.host}:{port}/api2/json')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""Provisioning load test: drives the Flask routes against the fake Proxmox API.
+
+Starts bench/fake_proxmox.py in-process, builds the app on a throwaway SQLite
+database and runs three scenarios through the Flask test client:
+
+  approve       N single approvals (POST /admin/vm_requests/<id>/status)
+  bulk_approve  one POST /admin/vm_requests/bulk_approve with N ids
+  addip         N hookscript reports (POST /addip) from --threads threads
+
+For each it prints throughput, p50/p99 latency, DB queries per request and,
+for the approval scenarios, the time until every VM reached "created".
+
+    python bench/run_bench.py -n 50 --latency 0.02 --clone-time 1 [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_proxmox  # noqa: E402
+from config import PASSWORD_HASH, PROXMOX, RATE_LIMIT  # noqa: E402
+
+ADDIP_VMID_BASE = 500000
+
+
+class QueryCounter:
+    """Counts DBAPI cursor executions on an engine."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+
+def summarize(name, latencies, elapsed, queries, statuses, **extra):
+    result = {
+        'scenario': name,
+        'requests': len(latencies),
+        'errors': sum(1 for s in statuses if s >= 400),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        'queries': queries,
+        'queries_per_request': round(queries / len(latencies), 1) if latencies else 0.0,
+    }
+    result.update(extra)
+    return result
+
+
+def login(app):
+    client = app.test_client()
+    response = client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'adminpassword'})
+    # a successful login renders the profile page; failures redirect back to the form
+    if response.status_code != 200:
+        raise SystemExit(f'admin login failed ({response.status_code})')
+    return client
+
+
+def seed_requests(app, count, prefix, vmid_base=None):
+    """Insert ``count`` pending requests for the admin user and return their ids."""
+    from models.connection import db
+    from models.model import User, VMRequest
+    with app.app_context():
+        user = db.session.execute(db.select(User).filter_by(email='admin@example.com')).scalar_one()
+        rows = [VMRequest(user_id=user.id, vm_name=f'{prefix}-{i}', vm_tier='bronze', status='pending',
+                          vmid=vmid_base + i if vmid_base is not None else None)
+                for i in range(count)]
+        db.session.add_all(rows)
+        db.session.commit()
+        return [row.id for row in rows]
+
+
+def wait_created(app, ids, timeout):
+    """Seconds until every request in ``ids`` left the queue, and how many failed."""
+    from models.connection import db
+    from models.model import VMRequest
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        with app.app_context():
+            statuses = db.session.execute(
+                db.select(VMRequest.status).where(VMRequest.id.in_(ids))).scalars().all()
+            db.session.remove()
+        if all(s in ('created', 'error') for s in statuses):
+            return round(time.perf_counter() - start, 2), statuses.count('error')
+        time.sleep(0.1)
+    return None, None
+
+
+def run_approve(app, counter, n, timeout):
+    ids = seed_requests(app, n, 'approve')
+    client = login(app)
+    latencies, statuses = [], []
+    before = counter.count
+    start = time.perf_counter()
+    for req_id in ids:
+        t = time.perf_counter()
+        response = client.post(f'/admin/vm_requests/{req_id}/status', data={'status': 'approved'})
+        latencies.append(time.perf_counter() - t)
+        statuses.append(response.status_code)
+    elapsed = time.perf_counter() - start
+    queries = counter.count - before
+    drain, failed = wait_created(app, ids, timeout)
+    return summarize('approve', latencies, elapsed, queries, statuses,
+                     seconds_until_created=drain, failed_vms=failed)
+
+
+def run_bulk_approve(app, counter, n, timeout):
+    ids = seed_requests(app, n, 'bulk')
+    client = login(app)
+    before = counter.count
+    start = time.perf_counter()
+    response = client.post('/admin/vm_requests/bulk_approve', data={'req_ids': ids})
+    elapsed = time.perf_counter() - start
+    queries = counter.count - before
+    drain, failed = wait_created(app, ids, timeout)
+    return summarize('bulk_approve', [elapsed], elapsed, queries, [response.status_code],
+                     vms=n, seconds_until_created=drain, failed_vms=failed)
+
+
+def run_addip(app, counter, n, threads):
+    seed_requests(app, n, 'addip', vmid_base=ADDIP_VMID_BASE)
+    local = threading.local()
+
+    def report(i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        t = time.perf_counter()
+        response = local.client.post('/addip', json={'vmid': ADDIP_VMID_BASE + i, 'ip': f'10.0.{i // 250}.{i % 250 + 1}'})
+        return time.perf_counter() - t, response.status_code
+
+    before = counter.count
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(report, range(n)))
+    elapsed = time.perf_counter() - start
+    queries = counter.count - before
+    return summarize('addip', [r[0] for r in results], elapsed, queries, [r[1] for r in results], threads=threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=50, help='requests per scenario')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients for /addip')
+    parser.add_argument('--scenarios', default='approve,bulk_approve,addip')
+    parser.add_argument('--latency', type=float, default=0.01, help='fake API latency per call (s)')
+    parser.add_argument('--clone-time', type=float, default=0.5, help='fake clone/create duration (s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability a fake task fails')
+    parser.add_argument('--nodes', default='px1,px2,px3')
+    parser.add_argument('--timeout', type=float, default=120, help='max seconds to wait for VMs to be created')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep RATE_LIMIT on (all bench clients share one IP)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    cluster = fake_proxmox.FakeCluster(nodes=args.nodes.split(','), latency=args.latency,
+                                       clone_time=args.clone_time, failure_rate=args.failure_rate)
+    server, port = fake_proxmox.serve(cluster)
+    PROXMOX.update(host=f'127.0.0.1:{port}', user='root@pam', password='bench', verify_ssl=False,
+                   task_poll_min=0.2, task_poll_max=1)
+    # hashing cost is not what this measures
+    PASSWORD_HASH['workers'] = 0
+    RATE_LIMIT['enabled'] = args.rate_limit
+
+    import app as appmod
+    from models.connection import db
+    from models.model import init_db
+
+    workdir = tempfile.mkdtemp(prefix='codice-bench-')
+    app = appmod.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'ENABLE_MIGRATIONS': False,
+        'TESTING': True,
+    })
+    with app.app_context():
+        db.create_all()
+        init_db()
+        counter = QueryCounter(db.engine)
+    appmod.start_services(app)
+
+    results = []
+    for scenario in args.scenarios.split(','):
+        if scenario == 'approve':
+            results.append(run_approve(app, counter, args.requests, args.timeout))
+        elif scenario == 'bulk_approve':
+            results.append(run_bulk_approve(app, counter, args.requests, args.timeout))
+        elif scenario == 'addip':
+            results.append(run_addip(app, counter, args.requests, args.threads))
+        else:
+            parser.error(f'unknown scenario: {scenario}')
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps({'proxmox_calls': cluster.calls, 'results': results}, indent=2))
+        return
+    for r in results:
+        line = (f"{r['scenario']:<13} {r['requests']:>5} req  {r['throughput_rps']:>8} req/s  "
+                f"p50 {r['p50_ms']:>8} ms  p99 {r['p99_ms']:>8} ms  {r['queries_per_request']:>6} queries/req  "
+                f"errors {r['errors']}")
+        if 'seconds_until_created' in r:
+            line += f"  created in {r['seconds_until_created']} s ({r['failed_vms']} failed)"
+        print(line)
+    print(f'Proxmox API calls: {cluster.calls}')
+
+
+if __name__ == '__main__':
+    main()
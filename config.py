@@ -1,6 +1,20 @@
 import os
+from urllib.parse import urlsplit
 DATABASE = "database.db"
 
+# SQLAlchemy engine tuning (see models/connection.py). Pool settings apply to
+# every file/server backend; the sqlite_* ones only when the URI is SQLite.
+DATABASE_ENGINE = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 20)),
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+    # seconds to wait for a lock instead of failing with "database is locked"
+    "sqlite_busy_timeout": 15,
+    "sqlite_wal": True,
+}
+
 
 PROXMOX = {
 "host": "192.168.56.16",
@@ -9,16 +23,29 @@ PROXMOX = {
 "verify_ssl": False,
 # default requests timeout (seconds) for Proxmox API calls
 "timeout": 30,
+# max keep-alive connections kept open to the API host by the shared client
+"pool_maxsize": 10,
+# renew the auth ticket (valid 2h) once it is older than this many seconds
+"ticket_renew_age": 5400,
+"ticket_max_age": 7000,
+# Proxmox task tracking: max seconds to wait for a task, adaptive poll interval bounds
+"task_timeout": 300,
+"task_poll_min": 1,
+"task_poll_max": 10,
 }
 
 
+# "clone": linked clones share the template's disk (near-instant, copy-on-write),
+# full clones copy it; "storage": where the VM disks go (full clones and creates);
+# "lifetime_days": lease of a new VM (None = no expiry, see LEASES)
 VM_TYPES = {
-"bronze": {"cpu": 1, "ram": 2048, "disk": 20},
-"silver": {"cpu": 2, "ram": 4096, "disk": 40},
-"gold": {"cpu": 4, "ram": 8192, "disk": 60},
+"bronze": {"cpu": 1, "ram": 2048, "disk": 20, "clone": "linked", "storage": "local-lvm", "lifetime_days": 30},
+"silver": {"cpu": 2, "ram": 4096, "disk": 40, "clone": "linked", "storage": "local-lvm", "lifetime_days": 60},
+"gold": {"cpu": 4, "ram": 8192, "disk": 60, "clone": "full", "storage": "local-lvm", "lifetime_days": 90},
 }
 
-# Node to target for VM creation (match your cluster node name)
+# Node to target for VM creation (match your cluster node name); used as the
+# fallback when the placement engine cannot read the cluster state
 PROXMOX["node"] = "px2"
 # Whether to disable KVM for newly created VMs (useful for nested environments)
 PROXMOX["disable_kvm_by_default"] = True
@@ -28,4 +55,233 @@ CLOUDINIT_TEMPLATES = {
     'bronze': 100,
     'silver': 200,
     'gold': 300,
-}
\ No newline at end of file
+}
+
+# Background provisioning of approved VM requests (see services/provisioning.py)
+PROVISIONING = {
+    # creations running at once across all the processes (slots in the
+    # service_lock table); also the size of each process's thread pool
+    "workers": int(os.getenv("PROVISIONING_WORKERS", 4)),
+    # clones running at once on the same node, across all the processes
+    "per_node": int(os.getenv("PROVISIONING_PER_NODE", 2)),
+    # seconds between two looks for a free slot held by another process
+    "slot_poll": 2,
+    # seconds between heartbeats of a job waiting on a Proxmox task
+    "heartbeat": 30,
+    # a running job without heartbeat for this long is resumed by any process
+    "stale_after": 120,
+    # seconds between two looks for stale jobs
+    "reconcile_interval": 60,
+    # runs of a job (interrupted ones are rolled back and retried up to this)
+    "max_attempts": 3,
+}
+
+# Copies of the cloud-init templates on each node, so clones never copy a disk
+# across the network (see services/clone_planner.py)
+TEMPLATE_REPLICAS = {
+    # off by default: create replicas with `flask replicate-templates`; when on,
+    # every worker checks for missing ones (one at a time, see service_lock)
+    "enabled": os.getenv("TEMPLATE_REPLICAS_ENABLED", "0") == "1",
+    # name of a replica; replicas are found on the cluster by this name
+    "name": "{template}-{node}",
+    # replicas that already exist under other names: {tier: {node: vmid}}
+    "known": {},
+    # seconds between checks for missing replicas (a clone from a remote node triggers one)
+    "interval": 3600,
+}
+
+# Range of VMIDs reserved for VMs created by the app (see services/vmid_pool.py);
+# keep it clear of the template ids above
+VMID_POOL = {
+    "start": 1000,
+    "end": 99999,
+    # ids reserved in the database per round-trip
+    "batch": 20,
+}
+
+# Placement of new VMs across nodes (see services/placement.py)
+PLACEMENT = {
+    # least_loaded, bin_packing or spread (or any policy registered with register_policy)
+    "policy": os.getenv("PLACEMENT_POLICY", "least_loaded"),
+    # restrict placement to these nodes; None means every online node
+    "nodes": None,
+    # storage that must have room for the VM disk on the target node, for
+    # tiers without a "storage" in VM_TYPES
+    "storage": "local-lvm",
+    # max age (seconds) of the cluster snapshot used for a placement decision
+    "cache_ttl": 15,
+}
+
+# Pool of pre-cloned, stopped VMs per tier handed out on approval (see services/warm_pool.py)
+WARM_POOL = {
+    "enabled": os.getenv("WARM_POOL_ENABLED", "0") == "1",
+    # VMs kept ready per tier
+    "size": {"bronze": 2, "silver": 1, "gold": 0},
+    # seconds between pool checks (a claim triggers a refill immediately)
+    "refill_interval": 60,
+}
+
+# Background sync of /cluster/resources used for live VM status and placement
+# (see services/cluster_sync.py)
+CLUSTER_SYNC = {
+    "enabled": os.getenv("CLUSTER_SYNC_ENABLED", "1") == "1",
+    # seconds between bulk refreshes
+    "interval": 10,
+}
+
+# Cache of logged-in users and their roles used by Flask-Login's user_loader
+# (see models/user_cache.py)
+USER_CACHE = {
+    # seconds before a cached user is re-read (bounds staleness across processes)
+    "ttl": 60,
+}
+
+# Password hashing (see utils/hashing.py). "method" is the full werkzeug method
+# string; hashes made with anything else are upgraded on the next login.
+PASSWORD_HASH = {
+    "method": os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1"),
+    # processes hashing in parallel per gunicorn worker (so workers x this in
+    # total); 0 hashes inline in the request thread
+    "workers": int(os.getenv("PASSWORD_HASH_WORKERS", 1)),
+    # hashes queued or running at once before callers have to wait
+    "max_pending": 64,
+    # seconds to wait for a slot before answering "busy"
+    "queue_timeout": 2,
+}
+
+# JSON API (see routes/api.py). Automation authenticates with
+# "Authorization: Bearer <token>"; admins can also use their browser session.
+API = {
+    "tokens": [t for t in os.getenv("API_TOKENS", "").split(",") if t],
+    "page_size": 100,
+    "max_page_size": 1000,
+    # rows fetched per round-trip by the NDJSON export
+    "export_batch": 1000,
+}
+
+# Per-request instrumentation (see utils/instrumentation.py): query and Proxmox
+# call counts/timings in a Server-Timing header and a log line for slow requests
+INSTRUMENTATION = {
+    "enabled": os.getenv("INSTRUMENTATION_ENABLED", "1") == "1",
+    "server_timing": True,
+    # requests slower than this (ms) are logged with their breakdown
+    "slow_ms": int(os.getenv("SLOW_REQUEST_MS", 500)),
+    # Proxmox API calls slower than this (ms) are logged, also from background workers
+    "slow_proxmox_ms": 2000,
+    # fraction of requests run under cProfile (0 = off); only slow ones are logged
+    "profile_rate": float(os.getenv("PROFILE_RATE", 0)),
+    # functions listed per profile
+    "profile_top": 25,
+}
+
+# Prometheus metrics served at /metrics (see utils/metrics.py, routes/metrics.py)
+METRICS = {
+    "enabled": os.getenv("METRICS_ENABLED", "1") == "1",
+    # if set, scrapers must send "Authorization: Bearer <token>"
+    "token": os.getenv("METRICS_TOKEN"),
+    # directory shared by the gunicorn workers: /metrics then reports the
+    # counters and histograms of all of them (unset = the answering process only)
+    "multiproc_dir": os.getenv("METRICS_DIR"),
+    # seconds between two writes of a process's metrics file
+    "flush_interval": 5,
+}
+
+# Quotas and admission control (see services/admission.py). Requests over a
+# quota are refused; requests the cluster has no room for wait as "waiting"
+# and become "pending" once capacity frees up. Limits are on what the user's
+# requests hold (pending, waiting, creating, created); missing keys mean no limit.
+QUOTAS = {
+    "enabled": os.getenv("QUOTAS_ENABLED", "1") == "1",
+    # per user; "ram" in MB, "disk" in GB like VM_TYPES
+    "user": {"vms": 5, "cpu": 8, "ram": 16384, "disk": 200},
+    # per-user overrides by username, e.g. {"alice": {"vms": 10}}
+    "users": {},
+    # shared by all the users of a role, e.g. {"user": {"vms": 200}}
+    "role": {},
+    # per tier across all users, e.g. {"gold": {"vms": 10}}
+    "tier": {},
+    # roles not subject to any quota (capacity still applies)
+    "exempt_roles": ["admin"],
+    # fraction of the online nodes' CPU/RAM/disk that admitted requests may
+    # hold (above 1 overcommits); cpu counts vCPUs against physical cores
+    "capacity": {"cpu": 4.0, "ram": 1.0, "disk": 1.0},
+}
+
+# Token-bucket rate limits (see utils/ratelimit.py): "rate" tokens per second
+# refill a bucket of "burst" tokens, one bucket per key
+RATE_LIMIT = {
+    "enabled": os.getenv("RATE_LIMIT_ENABLED", "1") == "1",
+    # share buckets across workers/hosts (needs the redis package); unset = per process
+    "redis_url": os.getenv("RATE_LIMIT_REDIS_URL"),
+    "redis_prefix": "codice:rl:",
+    # take the client IP from X-Forwarded-For (only behind a proxy that sets it)
+    "behind_proxy": os.getenv("BEHIND_PROXY", "0") == "1",
+    "rules": {
+        # /addip calls per client IP. The hookscripts all run on the Proxmox
+        # nodes, which share one bucket per node: these are exempt ("exempt",
+        # the API host and PROXMOX_NODE_IPS, comma separated) and only the
+        # per-VM bucket below throttles them
+        "addip_ip": {"rate": 20, "burst": 200, "exempt": [
+            urlsplit("//" + PROXMOX["host"]).hostname,
+            *filter(None, os.getenv("PROXMOX_NODE_IPS", "").replace(" ", "").split(",")),
+        ]},
+        # /addip reports per VM
+        "addip_vmid": {"rate": 0.2, "burst": 10},
+        # login attempts per client IP and per account
+        "login_ip": {"rate": 0.5, "burst": 20},
+        "login_account": {"rate": 1 / 60, "burst": 5},
+    },
+    # seconds during which the same vmid/IP report is answered without a DB write
+    "coalesce_window": 30,
+}
+
+# Bulk start/shutdown/stop/destroy of VMs (see services/lifecycle.py)
+LIFECYCLE = {
+    # max concurrent per-VM calls (shutdown, destroy)
+    "parallel": int(os.getenv("LIFECYCLE_PARALLEL", 8)),
+    # VMs per startall/stopall task
+    "bulk_chunk": 50,
+    # extra seconds a bulk task may take per VM on top of PROXMOX['task_timeout']
+    "bulk_per_vm": 30,
+}
+
+# Lease expiry of created VMs (see services/leases.py): at expiry a VM is
+# stopped ("expired"), then destroyed after the grace period
+LEASES = {
+    "enabled": os.getenv("LEASES_ENABLED", "1") == "1",
+    # seconds between passes of the reaper
+    "interval": 300,
+    "grace_days": 7,
+    # leases handled per pass
+    "batch": 50,
+    # a VM idle this long expires early (0 = never); idle means CPU below
+    # idle_cpu and network traffic below idle_net_bps (bytes/s, in + out)
+    "idle_days": 14,
+    "idle_cpu": 0.02,
+    "idle_net_bps": 2048,
+}
+
+# Live VM request updates streamed as Server-Sent Events (see services/events.py)
+EVENTS = {
+    "enabled": os.getenv("EVENTS_ENABLED", "1") == "1",
+    # seconds between keepalive comments on an idle stream
+    "heartbeat": 15,
+    # milliseconds the browser waits before reconnecting
+    "retry_ms": 5000,
+    # events buffered per stream; a client that falls this far behind is
+    # disconnected and gets a fresh snapshot on reconnect
+    "queue_size": 100,
+    # open streams per worker process, 503 beyond. gevent workers (the
+    # default, see gunicorn.conf.py) hold a stream in a greenlet; a gthread
+    # worker spends one of its WORKER_THREADS per open stream, so keep most
+    # of them for normal requests
+    "max_subscribers": int(os.getenv("EVENTS_MAX_STREAMS") or (
+        1000 if os.getenv("WORKER_CLASS", "gevent") in ("gevent", "eventlet")
+        else max(1, int(os.getenv("WORKER_THREADS", 8)) // 4))),
+    # deliver events of every process (workers, CLI) through Redis pub/sub
+    # (needs the redis package); unset = streams only see their own process
+    "redis_url": os.getenv("EVENTS_REDIS_URL"),
+    "redis_channel": "codice:events",
+    # rows in the snapshot sent when a stream opens
+    "snapshot_limit": 500,
+}
@@ -0,0 +1,26 @@
+# gunicorn settings for production: gunicorn -c gunicorn.conf.py wsgi:application
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# each worker process runs its own provisioning/sync threads and DB pool
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# gevent: an open /events stream is a greenlet waiting on its queue, so a
+# worker holds many idle streams; the background services (provisioning
+# pool, task tracker, sync loops) run as greenlets too, sockets are patched.
+# WORKER_CLASS=gthread spends one of WORKER_THREADS per open stream and then
+# accepts only WORKER_THREADS // 4 streams per worker (EVENTS in config.py)
+worker_class = os.getenv("WORKER_CLASS", "gevent")
+# concurrent connections (streams included) per gevent worker
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 1000))
+threads = int(os.getenv("WORKER_THREADS", 8))
+# long enough for slow hookscript bursts, short enough to recycle stuck workers
+timeout = int(os.getenv("WORKER_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5
+# recycle workers periodically to bound memory growth
+max_requests = 2000
+max_requests_jitter = 200
+# background threads must start in each worker, not in the master
+preload_app = False
+accesslog = "-"
@@ -1,3 +1,41 @@
+import sqlite3
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+from config import DATABASE_ENGINE
 
 db = SQLAlchemy()
+
+
+def engine_options(uri):
+    """SQLALCHEMY_ENGINE_OPTIONS for ``uri`` built from config.DATABASE_ENGINE."""
+    url = make_url(uri)
+    options = {'pool_pre_ping': DATABASE_ENGINE.get('pool_pre_ping', True)}
+    if url.get_backend_name() == 'sqlite':
+        # seconds a connection waits on a locked database before "database is locked"
+        options['connect_args'] = {'timeout': DATABASE_ENGINE.get('sqlite_busy_timeout', 15)}
+        if url.database in (None, '', ':memory:'):
+            # in-memory databases use a single shared connection, no pool to size
+            return options
+    options.update(
+        pool_size=DATABASE_ENGINE.get('pool_size', 10),
+        max_overflow=DATABASE_ENGINE.get('max_overflow', 20),
+        pool_timeout=DATABASE_ENGINE.get('pool_timeout', 30),
+        pool_recycle=DATABASE_ENGINE.get('pool_recycle', 1800),
+    )
+    return options
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers work while a writer commits; NORMAL sync is safe with WAL
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(DATABASE_ENGINE.get('sqlite_busy_timeout', 15) * 1000)}")
+    if DATABASE_ENGINE.get('sqlite_wal', True):
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.close()
@@ -1,5 +1,5 @@
 from models.connection import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from utils.hashing import hasher
 import datetime
 from flask_login import UserMixin
 
@@ -52,13 +52,19 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))  # Campo per la password criptata
 
-    roles = db.relationship('Role', secondary=user_roles, backref=db.backref('users', lazy='dynamic'))
+    # roles are needed for every has_role() check: load them with the user
+    roles = db.relationship('Role', secondary=user_roles, lazy='selectin', backref=db.backref('users', lazy='dynamic'))
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # on success, transparently upgrade hashes made with old parameters (caller commits)
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def __repr__(self):
         return f'<User {self.id} {self.username}>'
@@ -80,11 +86,118 @@ class VMRequest(db.Model):
     vm_tier = db.Column(db.String(50), nullable=False)  # e.g., bronze, silver, gold
     status = db.Column(db.String(50), default='pending')  # pending, approved, rejected
     timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    IP = db.Column(db.String(20), nullable=True,default="None")  # Indirizzo IP associato alla VM
+    IP = db.Column(db.String(255), nullable=True,default="None")  # Indirizzi IP (IPv4/IPv6, separati da virgola)
+    node = db.Column(db.String(64), nullable=True)  # nodo Proxmox della VM, noto dalla prenotazione in poi
+    # scadenza del lease (services/leases.py): la VM viene fermata e poi distrutta
+    expires_at = db.Column(db.DateTime, nullable=True)
+    idle_since = db.Column(db.DateTime, nullable=True)  # da quando la VM non usa CPU né rete
 
     user = db.relationship('User', backref=db.backref('vm_requests', lazy=True))
-    
+
+    __table_args__ = (
+        # admin listing: keyset pagination and the status filter
+        db.Index('ix_vm_request_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_vm_request_status_timestamp', 'status', 'timestamp'),
+        db.Index('ix_vm_request_user_id', 'user_id'),
+        # lease reaper: due leases in expiry order
+        db.Index('ix_vm_request_expires_at', 'expires_at'),
+    )
 
     def __repr__(self):
         return f'<VMRequest {self.id} by User {self.user_id}>'
     
+
+class ProvisioningJob(db.Model):
+    """Durable provisioning job for an approved VMRequest.
+
+    Rows are created on approval and picked up by the background workers in
+    services/provisioning.py; a job left in 'queued' is resubmitted at startup.
+    ``step`` is the next step to run (reserve, clone, wait, configure, start)
+    and ``node``/``vmid``/``upid`` what earlier steps produced, so a job
+    interrupted by a restart is resumed (or rolled back) from where it stopped.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, db.ForeignKey('vm_request.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    step = db.Column(db.String(20), nullable=False, default='reserve')
+    node = db.Column(db.String(64), nullable=True)
+    source_node = db.Column(db.String(64), nullable=True)
+    vmid = db.Column(db.Integer, nullable=True)
+    upid = db.Column(db.String(128), nullable=True)
+    # last sign of life of the worker running the job; stale running jobs are reconciled
+    heartbeat = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    vm_request = db.relationship('VMRequest', backref=db.backref('jobs', lazy=True))
+
+    def __repr__(self):
+        return f'<ProvisioningJob {self.id} for VMRequest {self.request_id} ({self.status})>'
+
+
+class VmidReservation(db.Model):
+    """A VMID handed out by services/vmid_pool.py.
+
+    ``owner`` is the allocator (process) holding the id while it is unassigned;
+    ``request_id`` is set once the id is bound to a VMRequest. Rows with both
+    columns NULL are reclaimed ids free to be reused.
+    """
+    vmid = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    request_id = db.Column(db.Integer, db.ForeignKey('vm_request.id'), nullable=True)
+    owner = db.Column(db.String(32), nullable=True)
+    reserved_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<VmidReservation {self.vmid} request={self.request_id}>'
+
+
+class WarmVM(db.Model):
+    """A pre-cloned, stopped VM kept ready for a tier by services/warm_pool.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    vmid = db.Column(db.Integer, nullable=False, unique=True)
+    vm_tier = db.Column(db.String(50), nullable=False)
+    node = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='cloning')  # cloning, ready
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<WarmVM {self.vmid} {self.vm_tier}@{self.node} ({self.status})>'
+
+
+class ResourceUsage(db.Model):
+    """Resources committed to VM requests, aggregated per scope.
+
+    One row per (scope_type, scope_key): ('user', '<id>'), ('role', '<name>'),
+    ('tier', '<tier>'), ('node', '<node>') and ('cluster', 'all'). Rows are
+    kept up to date incrementally by models/usage.py on every VMRequest
+    change and read by services/admission.py for quota and capacity checks.
+    """
+    __tablename__ = 'resource_usage'
+
+    scope_type = db.Column(db.String(16), primary_key=True)
+    scope_key = db.Column(db.String(80), primary_key=True)
+    cpu = db.Column(db.Integer, nullable=False, default=0)
+    ram = db.Column(db.Integer, nullable=False, default=0)  # MB
+    disk = db.Column(db.Integer, nullable=False, default=0)  # GB
+    vms = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ResourceUsage {self.scope_type}:{self.scope_key} vms={self.vms}>'
+
+
+class ServiceLock(db.Model):
+    """A background task run by one process at a time (see services/service_lock.py).
+
+    ``owner`` is the process holding the lock until ``expires_at``; an expired
+    lock can be taken over, so a process that died never blocks the task.
+    """
+    __tablename__ = 'service_lock'
+
+    name = db.Column(db.String(64), primary_key=True)
+    owner = db.Column(db.String(32), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<ServiceLock {self.name} by {self.owner} until {self.expires_at}>'
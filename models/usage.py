@@ -0,0 +1,137 @@
+import collections
+
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+
+from config import VM_TYPES
+from models.connection import db
+from models.model import ResourceUsage, Role, VMRequest, user_roles
+
+# statuses that hold a user's quota (a request waiting for capacity included)
+COUNTED = ('pending', 'waiting', 'creating', 'created', 'expired', 'deleting')
+# statuses admitted against the cluster capacity; an expired VM is stopped
+# but keeps its disk until it is destroyed
+ADMITTED = ('pending', 'creating', 'created', 'expired', 'deleting')
+
+CLUSTER = ('cluster', 'all')
+
+
+def demand(vm_tier):
+    """Resources of one VM of ``vm_tier`` in ResourceUsage units."""
+    cfg = VM_TYPES.get(vm_tier, {})
+    return {'cpu': cfg.get('cpu', 0), 'ram': cfg.get('ram', 0), 'disk': cfg.get('disk', 0), 'vms': 1}
+
+
+def scopes(user_id, vm_tier, status, node, roles):
+    """The ResourceUsage rows a request with these values counts against."""
+    if status not in COUNTED:
+        return []
+    keys = [('user', str(user_id)), ('tier', vm_tier)] + [('role', name) for name in roles]
+    if status in ADMITTED:
+        keys.append(CLUSTER)
+        if node:
+            keys.append(('node', node))
+    return keys
+
+
+def role_names(connection, user_id):
+    return connection.execute(
+        db.select(Role.name).join(user_roles, user_roles.c.role_id == Role.id)
+        .where(user_roles.c.user_id == user_id)
+    ).scalars().all()
+
+
+def apply(connection, deltas):
+    """Add ``deltas`` ({(scope_type, scope_key): {cpu, ram, disk, vms}}) to the aggregate."""
+    table = ResourceUsage.__table__
+    for (scope_type, scope_key), delta in deltas.items():
+        if not any(delta.values()):
+            continue
+        where = (table.c.scope_type == scope_type) & (table.c.scope_key == scope_key)
+        update = db.update(table).where(where).values(**{k: table.c[k] + v for k, v in delta.items()})
+        if connection.execute(update).rowcount:
+            continue
+        try:
+            with connection.begin_nested():
+                connection.execute(db.insert(table).values(scope_type=scope_type, scope_key=scope_key, **delta))
+        except IntegrityError:
+            # created by a concurrent transaction in the meantime
+            connection.execute(update)
+
+
+def _add(deltas, keys, vm_tier, sign):
+    amounts = demand(vm_tier)
+    for key in keys:
+        for name, value in amounts.items():
+            deltas[key][name] += sign * value
+
+
+def _track(target, value, oldvalue, initiator):
+    pass
+
+
+# active_history: load the previous value before an expired attribute is
+# overwritten, so after_update knows which rows to take the request out of
+for _attribute in (VMRequest.user_id, VMRequest.vm_tier, VMRequest.status, VMRequest.node):
+    event.listen(_attribute, 'set', _track, active_history=True)
+
+
+def _old_value(state, name):
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return history.unchanged[0] if history.unchanged else state.attrs[name].value
+
+
+@event.listens_for(VMRequest, 'after_insert')
+def _request_inserted(mapper, connection, target):
+    deltas = collections.defaultdict(collections.Counter)
+    status = target.status or 'pending'
+    keys = scopes(target.user_id, target.vm_tier, status, target.node, role_names(connection, target.user_id))
+    _add(deltas, keys, target.vm_tier, 1)
+    apply(connection, deltas)
+
+
+@event.listens_for(VMRequest, 'after_update')
+def _request_updated(mapper, connection, target):
+    state = inspect(target)
+    fields = ('user_id', 'vm_tier', 'status', 'node')
+    if not any(state.attrs[name].history.has_changes() for name in fields):
+        return
+    old = {name: _old_value(state, name) for name in fields}
+    if old['status'] not in COUNTED and target.status not in COUNTED:
+        return
+    roles = role_names(connection, target.user_id)
+    old_roles = roles if old['user_id'] == target.user_id else role_names(connection, old['user_id'])
+    deltas = collections.defaultdict(collections.Counter)
+    _add(deltas, scopes(old['user_id'], old['vm_tier'], old['status'], old['node'], old_roles), old['vm_tier'], -1)
+    _add(deltas, scopes(target.user_id, target.vm_tier, target.status, target.node, roles), target.vm_tier, 1)
+    apply(connection, deltas)
+
+
+@event.listens_for(VMRequest, 'after_delete')
+def _request_deleted(mapper, connection, target):
+    deltas = collections.defaultdict(collections.Counter)
+    old = {name: _old_value(inspect(target), name) for name in ('user_id', 'vm_tier', 'status', 'node')}
+    _add(deltas, scopes(old['user_id'], old['vm_tier'], old['status'], old['node'],
+                        role_names(connection, old['user_id'])), old['vm_tier'], -1)
+    apply(connection, deltas)
+
+
+def rebuild(session):
+    """Recompute every ResourceUsage row from the vm_request table (after a VM_TYPES or role change)."""
+    connection = session.connection()
+    roles = collections.defaultdict(list)
+    for user_id, name in connection.execute(
+            db.select(user_roles.c.user_id, Role.name).join(Role, Role.id == user_roles.c.role_id)):
+        roles[user_id].append(name)
+    deltas = collections.defaultdict(collections.Counter)
+    rows = connection.execute(
+        db.select(VMRequest.user_id, VMRequest.vm_tier, VMRequest.status, VMRequest.node)
+        .where(VMRequest.status.in_(COUNTED))
+    )
+    for user_id, vm_tier, status, node in rows:
+        _add(deltas, scopes(user_id, vm_tier, status, node, roles[user_id]), vm_tier, 1)
+    connection.execute(db.delete(ResourceUsage.__table__))
+    apply(connection, deltas)
+    session.commit()
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session, selectinload
+
+from config import USER_CACHE
+from models.connection import db
+from models.model import Role, User, VMRequest
+
+
+class CachedUser(UserMixin):
+    """Detached snapshot of a User and its role names, safe to share between requests.
+
+    This is what Flask-Login's user_loader returns, so current_user and
+    has_role() need no query. Anything else (vm_requests) is read on demand.
+    """
+
+    def __init__(self, id, username, email, roles):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.roles = frozenset(roles)
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.email, [role.name for role in user.roles])
+
+    def has_role(self, role_name):
+        return role_name in self.roles
+
+    @property
+    def vm_requests(self):
+        return db.session.execute(
+            db.select(VMRequest).filter_by(user_id=self.id).order_by(VMRequest.id)
+        ).scalars().all()
+
+    def to_json(self):
+        return {'username': self.username, 'email': self.email, 'id': self.id}
+
+    def __repr__(self):
+        return f'<CachedUser {self.id} {self.username}>'
+
+
+class UserCache:
+    """Process-wide cache of CachedUser objects with a TTL (USER_CACHE['ttl']).
+
+    Entries are dropped when a commit touches the user or its roles; other
+    processes see the change when their entry expires. Within one request
+    Flask-Login already keeps the loaded user on ``g``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, user_id):
+        user_id = int(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        user = db.session.execute(
+            db.select(User).options(selectinload(User.roles)).filter_by(id=user_id)
+        ).scalar_one_or_none()
+        if user is None:
+            return None
+        cached = CachedUser.from_user(user)
+        with self._lock:
+            self._entries[user_id] = (now + USER_CACHE.get('ttl', 60), cached)
+        return cached
+
+    def invalidate(self, user_id=None):
+        """Drop one user, or every user when ``user_id`` is None."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(user_id), None)
+
+
+user_cache = UserCache()
+
+
+def _mark(target, user_id):
+    # invalidate once the change is committed, so a concurrent reload can't cache stale data
+    session = object_session(target) or db.session()
+    session.info.setdefault('user_cache_invalidate', set()).add(user_id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    _mark(target, target.id)
+
+
+@event.listens_for(User.roles, 'append')
+@event.listens_for(User.roles, 'remove')
+def _roles_changed(target, value, initiator):
+    if target.id is not None:
+        _mark(target, target.id)
+
+
+@event.listens_for(Role, 'after_update')
+@event.listens_for(Role, 'after_delete')
+def _role_changed(mapper, connection, target):
+    # a renamed/removed role may belong to anyone
+    _mark(target, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    for user_id in session.info.pop('user_cache_invalidate', ()):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('user_cache_invalidate', None)
@@ -1,123 +1,396 @@
 # NOTE: Portions of this file were generated or modified with the assistance of GitHub Copilot (a chatbot).
 from config import PROXMOX, VM_TYPES, CLOUDINIT_TEMPLATES
-import requests
+import threading
 import time
 import logging
+from concurrent.futures import Future
 from proxmoxer import ProxmoxAPI
+from requests.adapters import HTTPAdapter
+from utils.instrumentation import record_proxmox_call
+from utils.metrics import CREATE_VM_PHASE
 
 LOG = logging.getLogger(__name__)
 
 
-proxmox = None
-
 # NOTE: removed _retry_api helper; calls now invoke the proxmox API methods directly.
 
 
-def create_vm(vm_name, vm_tier, ci_user=None, ci_password=None):
-    """Create a VM on Proxmox and return the allocated vmid.
+class ProxmoxSessionManager:
+    """Thread-safe cache of authenticated ProxmoxAPI clients keyed by (host, user).
 
-    Cloud-init templates are selected based on the VM tier (bronze/silver/gold).
+    Each client keeps its requests session (and therefore its keep-alive HTTPS
+    connections) for the life of the process. Tickets expire after two hours;
+    they are renewed here, under a lock, once they are older than
+    PROXMOX['ticket_renew_age'] so that concurrent threads never race on the
+    renewal that proxmoxer would otherwise do lazily inside each request.
     """
-    proxmox = ProxmoxAPI(PROXMOX['host'], user=PROXMOX['user'], password=PROXMOX['password'], verify_ssl=PROXMOX['verify_ssl'])
-    cfg = VM_TYPES[vm_tier]
 
-    # get next available vmid from cluster
-    vmid = proxmox.cluster.nextid.get()
-
-    node = PROXMOX.get('node', 'pve')
-
-    create_kwargs = dict(
-        vmid=vmid,
-        name=vm_name,
-        cores=cfg["cpu"],
-        memory=cfg["ram"],
-        net0="virtio,bridge=vmbr0",
-        scsihw="virtio-scsi-pci",
-        scsi0=f"local-lvm:{cfg['disk']}",
-        ostype="l26",
-    )
-
-    # if a cloud-init template is available for this category, try to clone it
-    cloned = False
-    template_vmid = CLOUDINIT_TEMPLATES.get(vm_tier)
-    if template_vmid:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get(self, host=None, user=None, password=None):
+        host = host or PROXMOX['host']
+        user = user or PROXMOX['user']
+        key = (host, user)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._connect(host, user, password or PROXMOX['password'])
+                self._clients[key] = client
+            else:
+                self._renew_if_needed(key, client)
+            return self._clients[key]
+
+    def invalidate(self, host=None, user=None, client=None):
+        """Drop a cached client, e.g. after an authentication error.
+
+        With ``client``, only if that is still the cached one, so threads
+        rejected with the same ticket log in again once between them. The
+        session is left open: other threads may still be using it.
+        """
+        key = (host or PROXMOX['host'], user or PROXMOX['user'])
+        with self._lock:
+            if client is None or self._clients.get(key) is client:
+                self._clients.pop(key, None)
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client._store['session'].close()
+
+    def _connect(self, host, user, password):
+        client = ProxmoxAPI(
+            host,
+            user=user,
+            password=password,
+            verify_ssl=PROXMOX['verify_ssl'],
+            timeout=PROXMOX.get('timeout', 30),
+        )
+        session = client._store['session']
+        # size the connection pool for the provisioning workers sharing this client
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PROXMOX.get('pool_maxsize', 10))
+        session.mount('https://', adapter)
+        # renewal is driven by the manager; keep proxmoxer's own check as a backstop only
+        session.auth.renew_age = PROXMOX.get('ticket_max_age', 7000)
+        # per-request call counts/timings and slow call logging
+        session.hooks['response'].append(record_proxmox_call)
+        session.hooks['response'].append(self._reauthenticate(host, user, client))
+        return client
+
+    def _reauthenticate(self, host, user, client):
+        """Response hook: on a 401 (ticket rejected early) log in again and retry once."""
+        def hook(response, *args, **kwargs):
+            if response.status_code != 401 or getattr(response.request, 'reauthenticated', False):
+                return response
+            LOG.warning('Proxmox rejected the ticket of %s@%s, logging in again', user, host)
+            self.invalidate(host, user, client)
+            # one client for the new ticket and the resend
+            session = self.get(host, user)._store['session']
+            auth = session.auth
+            retry = response.request.copy()
+            retry.headers.pop('Cookie', None)
+            retry.prepare_cookies(auth.get_cookies())
+            if retry.method != 'GET':
+                retry.headers['CSRFPreventionToken'] = auth.csrf_prevention_token
+            retry.reauthenticated = True
+            # read the 401 so its connection goes back to the pool
+            response.content
+            return session.send(retry, **kwargs)
+        return hook
+
+    def _renew_if_needed(self, key, client):
+        auth = client._store['session'].auth
+        if time.monotonic() - getattr(auth, 'birth_time', 0) < PROXMOX.get('ticket_renew_age', 5400):
+            return
         try:
-            clone_ret = proxmox.nodes(node).qemu(int(template_vmid)).clone.post(
-                newid=vmid,
-                name=vm_name,
-                full=1,
-                target=node,
-            )
-            # wait for clone task to complete (block until finished)
-            upid = None
-            if isinstance(clone_ret, dict):
-                upid = clone_ret.get('data') or clone_ret.get('upid')
-            elif isinstance(clone_ret, str):
-                upid = clone_ret
-            if upid:
-                try:
-                    from proxmoxer.tools.tasks import Tasks
+            auth._get_new_tokens()
+        except Exception:
+            # ticket already expired or rejected: log in again from scratch
+            LOG.warning('Proxmox ticket renewal for %s@%s failed, logging in again', key[1], key[0])
+            client._store['session'].close()
+            self._clients[key] = self._connect(key[0], key[1], PROXMOX['password'])
+
+
+sessions = ProxmoxSessionManager()
+
+
+def get_proxmox():
+    """Return the shared, authenticated client for the configured cluster."""
+    return sessions.get()
+
+
+class TaskTracker:
+    """Waits for Proxmox tasks (UPIDs) on behalf of any number of callers.
+
+    A single daemon thread polls ``nodes/{node}/tasks`` once per node that has
+    outstanding tasks, instead of one status request per task per second. The
+    poll interval starts at PROXMOX['task_poll_min'] and backs off towards
+    PROXMOX['task_poll_max'] while nothing changes; it snaps back to the minimum
+    whenever a task finishes or a new one is tracked.
+    """
 
-                    task_status = Tasks.blocking_status(proxmox, upid, timeout=PROXMOX.get('task_timeout', 300))
+    # polls a task may be missing from the list before we ask for its status directly
+    MAX_MISSES = 3
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._thread = None
+        self._interval = PROXMOX.get('task_poll_min', 1)
+
+    def track(self, upid, node=None, timeout=None, callback=None):
+        """Start watching ``upid`` and return a Future resolved with its final status.
+
+        The result is the task entry as returned by Proxmox, with ``status`` set to
+        'stopped' and ``exitstatus`` holding 'OK' or the error text. The future
+        fails with TimeoutError if the task is still running after ``timeout``.
+        """
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        timeout = timeout if timeout is not None else PROXMOX.get('task_timeout', 300)
+        with self._cond:
+            self._pending[upid] = {
+                'node': node or upid_node(upid),
+                'future': future,
+                'deadline': time.monotonic() + timeout,
+                'since': upid_starttime(upid),
+                'misses': 0,
+            }
+            self._interval = PROXMOX.get('task_poll_min', 1)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='proxmox-task-tracker', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def wait(self, upid, node=None, timeout=None):
+        """Block until ``upid`` stops and return its status (see :meth:`track`)."""
+        return self.track(upid, node=node, timeout=timeout).result()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                self._cond.wait(self._interval)
+                by_node = {}
+                for upid, entry in self._pending.items():
+                    by_node.setdefault(entry['node'], {})[upid] = entry
+            finished = 0
+            for node, tasks in by_node.items():
+                try:
+                    finished += self._poll_node(node, tasks)
                 except Exception:
-                    # fallback: poll the task status endpoint
-                    task_status = None
-                    poll_start = time.monotonic()
-                    while True:
-                        try:
-                            task_status = proxmox.nodes(node).tasks(upid).status.get()
-                        except Exception:
-                            task_status = None
-                        if task_status and task_status.get('status') == 'stopped':
-                            break
-                        if time.monotonic() - poll_start > PROXMOX.get('task_timeout', 300):
-                            break
-                        time.sleep(1)
-                if task_status and task_status.get('exitstatus') != 'OK':
-                    LOG.error('Clone task %s finished with error: %s', upid, task_status)
-            # apply cloud-init on the cloned VM
-            cfgpost = {}
-            if ci_user:
-                cfgpost['ciuser'] = ci_user
-            if ci_password:
-                cfgpost['cipassword'] = ci_password
-            if cfgpost:
-                proxmox.nodes(node).qemu(int(vmid)).config.post(**cfgpost)
-            cloned = True
-        except Exception:
-            LOG.exception('Failed to clone template %s, falling back to full create', template_vmid)
-
-    if not cloned:
-        # send create request (with retries) and wait for task if present
-        create_ret = proxmox.nodes(node).qemu.create(**create_kwargs)
-        upid = None
-        if isinstance(create_ret, dict):
-            upid = create_ret.get('data') or create_ret.get('upid')
-        elif isinstance(create_ret, str):
-            upid = create_ret
-        if upid:
-            try:
-                from proxmoxer.tools.tasks import Tasks
-
-                task_status = Tasks.blocking_status(proxmox, upid, timeout=PROXMOX.get('task_timeout', 300))
-            except Exception:
-                task_status = None
-                poll_start = time.monotonic()
-                while True:
-                    try:
-                        task_status = proxmox.nodes(node).tasks(upid).status.get()
-                    except Exception:
-                        task_status = None
-                    if task_status and task_status.get('status') == 'stopped':
-                        break
-                    if time.monotonic() - poll_start > PROXMOX.get('task_timeout', 300):
-                        break
-                    time.sleep(1)
-            if task_status and task_status.get('exitstatus') != 'OK':
-                LOG.error('Create task %s finished with error: %s', upid, task_status)
-
-    # start the VM (after creation) - Proxmox may take a moment
-    proxmox.nodes(node).qemu(int(vmid)).status.start.post()
-
-    return int(vmid)
-    
\ No newline at end of file
+                    LOG.exception('Polling tasks on node %s failed', node)
+            finished += self._expire()
+            with self._cond:
+                if finished:
+                    self._interval = PROXMOX.get('task_poll_min', 1)
+                else:
+                    self._interval = min(self._interval * 2, PROXMOX.get('task_poll_max', 10))
+
+    def _poll_node(self, node, tasks):
+        proxmox = get_proxmox()
+        since = min(entry['since'] for entry in tasks.values())
+        listed = proxmox.nodes(node).tasks.get(source='all', since=max(since - 1, 0), limit=max(500, 4 * len(tasks)))
+        seen = {item.get('upid'): item for item in listed or []}
+        finished = 0
+        for upid, entry in tasks.items():
+            item = seen.get(upid)
+            if item is None:
+                entry['misses'] += 1
+                if entry['misses'] < self.MAX_MISSES:
+                    continue
+                # not in the listing (e.g. filtered out): fall back to the per-task endpoint
+                entry['misses'] = 0
+                item = proxmox.nodes(node).tasks(upid).status.get()
+                if item and item.get('status') == 'stopped':
+                    self._resolve(upid, item)
+                    finished += 1
+                continue
+            if item.get('endtime'):
+                result = dict(item)
+                result['exitstatus'] = item.get('exitstatus', item.get('status'))
+                result['status'] = 'stopped'
+                self._resolve(upid, result)
+                finished += 1
+        return finished
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._cond:
+            expired = [upid for upid, entry in self._pending.items() if entry['deadline'] <= now]
+            entries = [self._pending.pop(upid) for upid in expired]
+        for upid, entry in zip(expired, entries):
+            entry['future'].set_exception(TimeoutError(f'Task {upid} still running after timeout'))
+        return len(expired)
+
+    def _resolve(self, upid, status):
+        with self._cond:
+            entry = self._pending.pop(upid, None)
+        if entry is not None and not entry['future'].done():
+            entry['future'].set_result(status)
+
+
+def upid_node(upid):
+    """Return the node name embedded in a UPID (UPID:node:pid:pstart:starttime:...)."""
+    return upid.split(':')[1]
+
+
+def upid_starttime(upid):
+    """Return the task start time (epoch seconds) embedded in a UPID, or 0."""
+    try:
+        return int(upid.split(':')[4], 16)
+    except (IndexError, ValueError):
+        return 0
+
+
+tasks = TaskTracker()
+
+
+def wait_for_task(upid, node=None, timeout=None):
+    """Wait for ``upid`` through the shared tracker; return its status or None on timeout."""
+    try:
+        return tasks.wait(upid, node=node, timeout=timeout)
+    except TimeoutError:
+        LOG.error('Timed out waiting for task %s', upid)
+        return None
+
+
+def task_upid(ret):
+    """Extract the UPID from the return value of a Proxmox task-starting call."""
+    if isinstance(ret, dict):
+        return ret.get('data') or ret.get('upid')
+    if isinstance(ret, str):
+        return ret
+    return None
+
+
+def cluster_vmids():
+    """Return the set of VMIDs (VMs and templates) present on the cluster."""
+    resources = get_proxmox().cluster.resources.get(type='vm')
+    return {int(item['vmid']) for item in resources or [] if 'vmid' in item}
+
+
+def start_clone(vm_tier, vmid, vm_name, node, source_node=None, full=True, template_vmid=None, storage=None):
+    """Start cloning a template into ``vmid`` on ``node``; return the UPID.
+
+    The template defaults to the tier's CLOUDINIT_TEMPLATES entry (see
+    services/clone_planner.py for per-node replicas). ``storage`` is the target
+    storage of a full clone; linked clones stay on the template's storage.
+    """
+    template_vmid = template_vmid or CLOUDINIT_TEMPLATES[vm_tier]
+    params = dict(newid=vmid, name=vm_name, full=1 if full else 0, target=node)
+    if full and storage:
+        params['storage'] = storage
+    with CREATE_VM_PHASE.time(phase='clone'):
+        clone_ret = get_proxmox().nodes(source_node or node).qemu(int(template_vmid)).clone.post(**params)
+    return task_upid(clone_ret)
+
+
+def start_create(vm_name, vm_tier, vmid, node):
+    """Start creating an empty VM sized for ``vm_tier`` (no template); return the UPID."""
+    cfg = VM_TYPES[vm_tier]
+    with CREATE_VM_PHASE.time(phase='create'):
+        create_ret = get_proxmox().nodes(node).qemu.create(
+            vmid=vmid,
+            name=vm_name,
+            cores=cfg["cpu"],
+            memory=cfg["ram"],
+            net0="virtio,bridge=vmbr0",
+            scsihw="virtio-scsi-pci",
+            scsi0=f"{cfg.get('storage', 'local-lvm')}:{cfg['disk']}",
+            ostype="l26",
+        )
+    return task_upid(create_ret)
+
+
+def clone_template(vm_tier, vmid, vm_name, node, source_node=None, full=True, template_vmid=None, storage=None):
+    """Clone the tier's cloud-init template into ``vmid`` on ``node`` and wait for it.
+
+    Linked clones (``full=False``) need the template on ``node`` itself.
+    Returns the final task status (None if it could not be determined).
+    """
+    # wait for clone task to complete (block until finished)
+    upid = start_clone(vm_tier, vmid, vm_name, node, source_node=source_node, full=full,
+                       template_vmid=template_vmid, storage=storage)
+    task_status = None
+    if upid:
+        with CREATE_VM_PHASE.time(phase='task_wait'):
+            task_status = wait_for_task(upid)
+        if task_status and task_status.get('exitstatus') != 'OK':
+            LOG.error('Clone task %s finished with error: %s', upid, task_status)
+    return task_status
+
+
+def convert_to_template(vmid, node):
+    """Turn a stopped VM into a template (used for per-node template replicas)."""
+    get_proxmox().nodes(node).qemu(int(vmid)).template.post()
+
+
+def configure_cloudinit(vmid, node, ci_user=None, ci_password=None, **extra):
+    """Apply cloud-init credentials (and any other config in ``extra``) to a VM."""
+    cfgpost = dict(extra)
+    if ci_user:
+        cfgpost['ciuser'] = ci_user
+    if ci_password:
+        cfgpost['cipassword'] = ci_password
+    if cfgpost:
+        with CREATE_VM_PHASE.time(phase='cloudinit'):
+            get_proxmox().nodes(node).qemu(int(vmid)).config.post(**cfgpost)
+
+
+def start_vm(vmid, node):
+    # Proxmox may take a moment before the VM is actually running
+    with CREATE_VM_PHASE.time(phase='start'):
+        get_proxmox().nodes(node).qemu(int(vmid)).status.start.post()
+
+
+def vm_status(vmid, node):
+    """Current status of a VM (``status`` is 'running', 'stopped', ...)."""
+    return get_proxmox().nodes(node).qemu(int(vmid)).status.current.get()
+
+
+def start_power(vmid, node, action):
+    """Start a power action (start, shutdown, stop) on one VM; return the UPID."""
+    return task_upid(getattr(get_proxmox().nodes(node).qemu(int(vmid)).status, action).post())
+
+
+def start_bulk(node, action, vmids):
+    """Start or stop many VMs of ``node`` in one task (``action``: startall/stopall); return the UPID."""
+    params = dict(vms=','.join(str(int(v)) for v in vmids))
+    if action == 'startall':
+        # without force startall skips VMs that are not marked onboot
+        params['force'] = 1
+    return task_upid(getattr(get_proxmox().nodes(node), action).post(**params))
+
+
+def start_destroy(vmid, node):
+    """Start deleting a VM and its disks; return the UPID."""
+    return task_upid(get_proxmox().nodes(node).qemu(int(vmid)).delete(purge=1))
+
+
+def wait_unlocked(vmid, node, beat=None):
+    """Wait while a VM is locked by a running task (e.g. an interrupted clone)."""
+    deadline = time.monotonic() + PROXMOX.get('task_timeout', 300)
+    while int(vmid) in cluster_vmids() and vm_status(vmid, node).get('lock'):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'VM {vmid} still locked')
+        if beat is not None:
+            beat()
+        time.sleep(PROXMOX.get('task_poll_max', 10))
+
+
+def destroy_vm(vmid, node):
+    """Delete a VM and its disks and wait for it; return the task status.
+
+    Returns None without calling Proxmox if ``vmid`` is not on the cluster.
+    """
+    if int(vmid) not in cluster_vmids():
+        return None
+    upid = start_destroy(vmid, node)
+    return wait_for_task(upid) if upid else None
+
@@ -0,0 +1,155 @@
+import datetime
+import functools
+import hmac
+import json
+
+from flask import Blueprint
+from flask import Response
+from flask import jsonify
+from flask import request
+from flask import stream_with_context
+from flask_login import current_user
+
+from config import API
+from models.connection import db
+from models.model import User, VMRequest
+from utils.pagination import keyset_paginate
+
+app = Blueprint('api', __name__)
+
+# public name -> column, for fields= projection
+VM_REQUEST_FIELDS = {
+    'id': VMRequest.id,
+    'user_id': VMRequest.user_id,
+    'username': User.username,
+    'vm_name': VMRequest.vm_name,
+    'vmid': VMRequest.vmid,
+    'vm_tier': VMRequest.vm_tier,
+    'status': VMRequest.status,
+    'timestamp': VMRequest.timestamp,
+    'expires_at': VMRequest.expires_at,
+    'ip': VMRequest.IP,
+}
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'email': User.email,
+}
+
+
+def api_auth_required(view):
+    """Allow a configured bearer token or a logged-in admin; answer 401 JSON otherwise."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            token = header[len('Bearer '):]
+            if any(hmac.compare_digest(token, allowed) for allowed in API['tokens']):
+                return view(*args, **kwargs)
+        elif current_user.is_authenticated and current_user.has_role('admin'):
+            return view(*args, **kwargs)
+        return jsonify({'error': 'unauthorized'}), 401
+    return wrapper
+
+
+def _projection(available):
+    """Columns selected by ?fields=a,b (all by default); raise ValueError on unknown names."""
+    names = request.args.get('fields')
+    if not names:
+        return dict(available)
+    selected = {}
+    for name in names.split(','):
+        name = name.strip()
+        if name not in available:
+            raise ValueError(f'unknown field: {name}')
+        selected[name] = available[name]
+    return selected
+
+
+def _serialize(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _vm_request_query(columns):
+    stmt = db.select(*[column.label(name) for name, column in columns.items()])
+    stmt = stmt.select_from(VMRequest)
+    if 'username' in columns:
+        stmt = stmt.join(User, User.id == VMRequest.user_id)
+    if request.args.get('status'):
+        stmt = stmt.where(VMRequest.status == request.args['status'])
+    if request.args.get('tier'):
+        stmt = stmt.where(VMRequest.vm_tier == request.args['tier'])
+    if request.args.get('user_id', type=int):
+        stmt = stmt.where(VMRequest.user_id == request.args.get('user_id', type=int))
+    return stmt
+
+
+def _page(stmt, key_column, wanted):
+    """One keyset page as a conditional JSON response (ETag / If-None-Match)."""
+    limit = max(1, min(request.args.get('limit', API['page_size'], type=int), API['max_page_size']))
+    rows, next_cursor = keyset_paginate(db.session, stmt, [key_column], cursor=request.args.get('after'),
+                                        limit=limit, descending=False, scalars=False)
+    data = [{name: _serialize(getattr(row, name)) for name in wanted} for row in rows]
+    response = jsonify({'data': data, 'next_cursor': next_cursor})
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/vm_requests')
+@api_auth_required
+def list_vm_requests():
+    try:
+        columns = _projection(VM_REQUEST_FIELDS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    wanted = list(columns)
+    # the sort key must be in the row even if not requested
+    columns.setdefault('id', VMRequest.id)
+    try:
+        return _page(_vm_request_query(columns), VMRequest.id, wanted)
+    except ValueError:
+        return jsonify({'error': 'invalid cursor'}), 400
+
+
+@app.route('/users')
+@api_auth_required
+def list_users():
+    try:
+        columns = _projection(USER_FIELDS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    wanted = list(columns)
+    columns.setdefault('id', User.id)
+    stmt = db.select(*[column.label(name) for name, column in columns.items()])
+    try:
+        return _page(stmt, User.id, wanted)
+    except ValueError:
+        return jsonify({'error': 'invalid cursor'}), 400
+
+
+@app.route('/vm_requests/export.ndjson')
+@api_auth_required
+def export_vm_requests():
+    """Stream every matching request as one JSON object per line.
+
+    Rows come from a server-side cursor in batches of API['export_batch'], so
+    memory stays flat whatever the table size.
+    """
+    try:
+        columns = _projection(VM_REQUEST_FIELDS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    stmt = _vm_request_query(columns).order_by(VMRequest.id).execution_options(yield_per=API['export_batch'])
+
+    def generate():
+        result = db.session.execute(stmt)
+        try:
+            for row in result:
+                yield json.dumps({name: _serialize(value) for name, value in row._mapping.items()}) + '\n'
+        finally:
+            result.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
@@ -12,6 +12,10 @@ from flask_login import login_required
 from flask_login import current_user
 
 from models.model import *
+from utils.hashing import HashingBusy
+from utils.ratelimit import client_ip, limiter
+from sqlalchemy.orm import selectinload
+from utils.pagination import keyset_paginate
 
 app = Blueprint("auth", __name__)
 
@@ -26,6 +30,12 @@ def login_post():
     password = request.form.get('password')
     remember = True if request.form.get('remember') else False
 
+    # checked before the user lookup and the (expensive) password hash
+    wait = limiter.hit('login_ip', client_ip()) or limiter.hit('login_account', (email or '').strip().lower())
+    if wait:
+        flash(f'Troppi tentativi di accesso, riprova tra {int(wait) + 1} secondi')
+        return render_template('auth/login.html'), 429, {'Retry-After': str(int(wait) + 1)}
+
     stmt = db.select(User).filter_by(email=email)
     user = db.session.execute(stmt).scalar_one_or_none()
 
@@ -34,10 +44,16 @@ def login_post():
     if not user:
         flash('We couldn\'t find your account')
         return redirect(url_for('auth.login')) # if the user doesn't exist or password is wrong, reload the page
-    if not user.check_password(password):
+    try:
+        valid = user.check_password(password)
+    except HashingBusy:
+        flash('Server occupato, riprova tra qualche secondo')
+        return render_template('auth/login.html'), 503
+    if not valid:
         flash('Wrong password')
         return redirect(url_for('auth.login'))
     # if the above check passes, then we know the user has the right credentials
+    db.session.commit()  # saves the upgraded hash, if check_password rehashed it
     login_user(user, remember=remember)
     return render_template('auth/profile.html' , name=current_user.username)
 
@@ -65,7 +81,11 @@ def signup_post():
     password = request.form.get('password')
 
     user = User(username=username, email=email)
-    user.set_password(password)  # Imposta la password criptata
+    try:
+        user.set_password(password)  # Imposta la password criptata
+    except HashingBusy:
+        flash('Server occupato, riprova tra qualche secondo')
+        return redirect(url_for('auth.signup'))
     db.session.add(user)  # equivalente a INSERT
     db.session.commit()
     flash('User created, please login')
@@ -77,5 +97,10 @@ def admin_page():
     if current_user.is_authenticated and not current_user.has_role('admin'):
         flash("Accesso non autorizzato!")
         return redirect(url_for('default.home'))
-    users = db.session.execute(db.select(User)).scalars().all()
-    return render_template('admin.html', users=users)
+    stmt = db.select(User).options(selectinload(User.roles))
+    try:
+        users, next_cursor = keyset_paginate(db.session, stmt, [User.id], cursor=request.args.get('after'),
+                                             limit=50, descending=False)
+    except ValueError:
+        return redirect(url_for('auth.admin_page'))
+    return render_template('admin.html', users=users, next_cursor=next_cursor)
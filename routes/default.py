@@ -1,6 +1,6 @@
 import os
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 from flask import Blueprint
 from flask import render_template
@@ -9,18 +9,26 @@ from flask import request
 from flask import flash
 from flask import redirect
 from flask import url_for
-from flask import current_app
 from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload
 
 
 from models.connection import db
 from models.model import User, VMRequest
-from utils.sanitize import sanitize_vm_name
-from proxmoxer import ProxmoxAPI
-from proxmox_api import create_vm
+from utils.pagination import keyset_paginate
+from utils.ratelimit import client_ip, limiter
+from utils.sanitize import normalize_ips, sanitize_vm_name
+from services.admission import QuotaExceeded, admission
+from services.cluster_sync import cluster_sync
+from services.events import broker
+from services.lifecycle import ACTIONS as LIFECYCLE_ACTIONS, WITH_VM, lifecycle
+from services.provisioning import queue as provisioning
 
 app = Blueprint('default', __name__) 
 
+# max VMs reported in one /addip call
+ADDIP_MAX_BATCH = 500
+
 
 @app.route('/')
 def home():
@@ -39,9 +47,17 @@ def requestVM():
         if vm_name != (vm_name_raw or '').strip():
             flash(f'VM name sanitized to "{vm_name}"')
         new_req = VMRequest(user_id=current_user.id, vm_name=vm_name, vm_tier=vm_type)
-        db.session.add(new_req)
+        try:
+            status = admission.admit(new_req, current_user)
+        except QuotaExceeded as e:
+            db.session.rollback()
+            flash(f'VM request refused: {e}')
+            return redirect(url_for('default.requestVM'))
         db.session.commit()
-        flash(f'VM request submitted: {vm_name} ({vm_type})')
+        if status == 'waiting':
+            flash(f'VM request submitted: {vm_name} ({vm_type}), waiting for free cluster capacity')
+        else:
+            flash(f'VM request submitted: {vm_name} ({vm_type})')
         return redirect(url_for('default.home'))
     return render_template('request.html', name=current_user.username)
 
@@ -53,43 +69,203 @@ def vm_requests():
     if current_user.is_authenticated and not current_user.has_role('admin'):
         flash("Accesso non autorizzato!")
         return redirect(url_for('default.home'))
-    stmt = db.select(VMRequest).order_by(VMRequest.timestamp.desc())
-    requests = db.session.execute(stmt).scalars().all()
-    return render_template('vm_requests.html', requests=requests)
+    filters = {
+        'status': request.args.get('status') or None,
+        'tier': request.args.get('tier') or None,
+        'user': request.args.get('user') or None,
+    }
+    per_page = max(1, min(request.args.get('per_page', 50, type=int), 200))
+    # joinedload: usernames come with the page instead of one query per row
+    stmt = db.select(VMRequest).options(joinedload(VMRequest.user))
+    if filters['status']:
+        stmt = stmt.where(VMRequest.status == filters['status'])
+    if filters['tier']:
+        stmt = stmt.where(VMRequest.vm_tier == filters['tier'])
+    if filters['user']:
+        user_id = db.select(User.id).where(User.username == filters['user']).scalar_subquery()
+        stmt = stmt.where(VMRequest.user_id == user_id)
+    try:
+        requests, next_cursor = keyset_paginate(
+            db.session, stmt, [VMRequest.timestamp, VMRequest.id],
+            cursor=request.args.get('after'), limit=per_page,
+        )
+    except ValueError:
+        flash('Invalid page cursor')
+        return redirect(url_for('default.vm_requests'))
+    # live power state/usage from the background cluster sync, no Proxmox call here
+    live = cluster_sync.vm_status()
+    return render_template('vm_requests.html', requests=requests, live=live,
+                           filters=filters, next_cursor=next_cursor, per_page=per_page)
+
+@app.route('/admin/vm_requests/bulk_approve', methods=['POST'])
+@login_required
+def bulk_approve_vm_requests():
+    if current_user.is_authenticated and not current_user.has_role('admin'):
+        flash("Accesso non autorizzato!")
+        return redirect(url_for('default.home'))
+    req_ids = request.form.getlist('req_ids', type=int)
+    if not req_ids:
+        flash('No VM requests selected')
+        return redirect(url_for('default.vm_requests'))
+    stmt = db.select(VMRequest).where(VMRequest.id.in_(req_ids))
+    found = {vmreq.id: vmreq for vmreq in db.session.execute(stmt).scalars()}
+    to_queue = []
+    # report the outcome of every selected row separately
+    for req_id in req_ids:
+        vmreq = found.get(req_id)
+        if vmreq is None:
+            flash(f'Request {req_id}: not found')
+        elif vmreq.status in WITH_VM:
+            flash(f'Request {req_id} ({vmreq.vm_name}): skipped, already {vmreq.status}')
+        elif vmreq.status != 'pending' and not admission.fits_cluster(vmreq):
+            vmreq.status = 'waiting'
+            flash(f'Request {req_id} ({vmreq.vm_name}): waiting, not enough free cluster capacity')
+        else:
+            # admitted now, so the next request's capacity check counts it
+            vmreq.status = 'pending'
+            to_queue.append(vmreq)
+            flash(f'Request {req_id} ({vmreq.vm_name}): VM creation queued')
+    if to_queue:
+        provisioning.enqueue_many(to_queue)
+    else:
+        db.session.commit()
+    return redirect(url_for('default.vm_requests'))
+
+@app.route('/admin/vm_requests/<int:req_id>/lease', methods=['POST'])
+@login_required
+def extend_vm_request_lease(req_id):
+    if current_user.is_authenticated and not current_user.has_role('admin'):
+        flash("Accesso non autorizzato!")
+        return redirect(url_for('default.home'))
+    days = request.form.get('days', type=int)
+    vmreq = db.session.get(VMRequest, req_id)
+    if not vmreq or vmreq.status not in ('created', 'expired') or not days or days < 1:
+        flash('Lease can only be extended by at least one day on a created VM')
+        return redirect(url_for('default.vm_requests'))
+    # an expired VM stays stopped: start it from the lifecycle buttons if needed
+    vmreq.status = 'created'
+    vmreq.expires_at = datetime.utcnow() + timedelta(days=days)
+    vmreq.idle_since = None
+    db.session.commit()
+    flash(f'Lease of {vmreq.vm_name} extended to {vmreq.expires_at:%Y-%m-%d %H:%M}')
+    return redirect(url_for('default.vm_requests'))
+
+@app.route('/admin/vm_requests/lifecycle', methods=['POST'])
+@login_required
+def lifecycle_vm_requests():
+    if current_user.is_authenticated and not current_user.has_role('admin'):
+        flash("Accesso non autorizzato!")
+        return redirect(url_for('default.home'))
+    action = request.form.get('action')
+    if action not in LIFECYCLE_ACTIONS:
+        flash('Invalid action')
+        return redirect(url_for('default.vm_requests'))
+    req_ids = request.form.getlist('req_ids', type=int)
+    older_than_days = request.form.get('older_than_days', type=int)
+    filters = {
+        'user': request.form.get('user') or None,
+        'tier': request.form.get('tier') or None,
+        'older_than': timedelta(days=older_than_days) if older_than_days else None,
+    }
+    if not req_ids and not any(filters.values()):
+        # never act on every VM of the cluster by accident
+        flash('Select VM requests or give at least one filter')
+        return redirect(url_for('default.vm_requests'))
+    stmt = lifecycle.select(ids=req_ids or None, **filters).with_only_columns(VMRequest.id)
+    ids = db.session.execute(stmt).scalars().all()
+    if not ids:
+        flash('No created VMs match the selection')
+        return redirect(url_for('default.vm_requests'))
+    lifecycle.submit(action, ids)
+    flash(f'{action} started for {len(ids)} VMs')
+    return redirect(url_for('default.vm_requests'))
 
 #Endpoint per aggiungere l'indirizzo IP associato alla VM
 #la richiesta arriva tramite hookscript all'avvio della VM richiesta dall'utente.
+#Accetta {"vmid": 101, "ip": "10.0.0.5"} (ip anche lista, IPv4/IPv6) oppure una lista di questi oggetti.
 @app.route("/addip", methods=["POST"])
 def add_ip():
+    wait = limiter.hit("addip_ip", client_ip())
+    if wait:
+        return jsonify({"error": "troppe richieste"}), 429, {"Retry-After": str(int(wait) + 1)}
+
     data = request.get_json(silent=True)
 
     if not data:
         return jsonify({"error": "JSON mancante"}), 400
 
-    vmid2 = data.get("vmid")
-    ip2 = data.get("ip")
+    batch = isinstance(data, list)
+    items = data if batch else [data]
+    if len(items) > ADDIP_MAX_BATCH:
+        return jsonify({"error": f"massimo {ADDIP_MAX_BATCH} elementi per richiesta"}), 413
+
+    rows = []
+    for item in items:
+        vmid2 = item.get("vmid") if isinstance(item, dict) else None
+        ip2 = item.get("ip") if isinstance(item, dict) else None
+        if not vmid2 or not ip2:
+            return jsonify({"error": "vmid o ip mancanti"}), 400
+        try:
+            rows.append({"b_vmid": int(vmid2), "b_ip": normalize_ips(ip2)})
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"vmid o ip non validi: {e}"}), 400
 
-    if not vmid2 or not ip2:
-        return jsonify({"error": "vmid o ip mancanti"}), 400
+    # the same vmid/IP reported again within the coalescing window (hookscript
+    # retries, several NICs coming up) is answered without touching the DB
+    recent = limiter.recent("addip", [str(row["b_vmid"]) for row in rows])
+    fresh = [row for row in rows if recent.get(str(row["b_vmid"])) != row["b_ip"]]
+    waits = limiter.hit_many("addip_vmid", [row["b_vmid"] for row in fresh])
+    allowed = [row for row, wait in zip(fresh, waits) if not wait]
 
-    stmt = db.select(VMRequest).filter_by(vmid=vmid2).scalar_one_or_none()
-    request = db.session.execute(stmt).scalars()
-    if not request:
-        return jsonify({"error": "Richiesta VM non trovata"}), 404
-    else:
-        request.ip = ip2
-        db.session.commit()
+    if not batch:
+        if not fresh:
+            return jsonify({"status": "ok", "vmid": rows[0]["b_vmid"], "ip": rows[0]["b_ip"],
+                            "coalesced": True}), 200
+        if not allowed:
+            return jsonify({"error": "troppe segnalazioni per questa VM"}), 429, {"Retry-After": str(int(waits[0]) + 1)}
+    if not allowed:
+        return jsonify({"status": "ok", "received": len(rows), "updated": 0,
+                        "coalesced": len(rows) - len(fresh), "limited": len(fresh)}), 200
 
+    # a single UPDATE ... WHERE vmid = ? (executemany for batches), no ORM load;
+    # writing the same value again is harmless, so hookscript retries are safe
+    table = VMRequest.__table__
+    stmt = (
+        db.update(table)
+        .where(table.c.vmid == db.bindparam("b_vmid"))
+        .values(IP=db.bindparam("b_ip"))
+    )
+    result = db.session.execute(stmt, allowed)
+    db.session.commit()
+    if result.rowcount and broker.has_subscribers:
+        # the Core UPDATE fires no ORM events: publish the new IPs here
+        broker.publish_requests(db.session.execute(
+            db.select(table.c.id, table.c.user_id, table.c.vm_name, table.c.vmid, table.c.status, table.c.IP)
+            .where(table.c.vmid.in_([row["b_vmid"] for row in allowed]))
+        ).all())
 
+    if not batch:
+        if result.rowcount == 0:
+            return jsonify({"error": "Richiesta VM non trovata"}), 404
+        limiter.remember("addip", {str(rows[0]["b_vmid"]): rows[0]["b_ip"]})
+        return jsonify({
+            "status": "ok",
+            "vmid": rows[0]["b_vmid"],
+            "ip": rows[0]["b_ip"]
+        }), 200
 
+    # executemany gives no per-row count: unknown vmids are remembered too,
+    # which only matters for a batch repeated within the window
+    limiter.remember("addip", {str(row["b_vmid"]): row["b_ip"] for row in allowed})
     return jsonify({
         "status": "ok",
-        "vmid": vmid2,
-        "ip": ip2
+        "received": len(rows),
+        "updated": result.rowcount,
+        "coalesced": len(rows) - len(fresh),
+        "limited": len(fresh) - len(allowed)
     }), 200
 
 
-
 @app.route('/admin/vm_requests/<int:req_id>/status', methods=['POST'])
 @login_required
 def update_vm_request_status(req_id):
@@ -104,35 +280,31 @@ def update_vm_request_status(req_id):
     if not vmreq:
         flash('VM request not found')
         return redirect(url_for('default.vm_requests'))
-    # handle approved -> trigger Proxmox VM creation
-    if new_status == 'approved':
-        vmreq.status = 'creating'
-        db.session.commit()
-        try:
-            # generate access credentials (do NOT store them on the request)
-            import secrets
-            access_user = 'root'
-            access_password = secrets.token_urlsafe(12)
-
-            # Pass credentials to the VM create call but avoid persisting them
-            vmid = create_vm(vmreq.vm_name, vmreq.vm_tier, ci_user=access_user, ci_password=access_password)
-        except Exception as e:
-            vmreq.status = 'error'
-            db.session.commit()
-            current_app.logger.exception('Failed to create VM via Proxmox')
-            flash(f'Failed to create VM: {e}')
-            return redirect(url_for('default.vm_requests'))
-        vmreq.vmid = vmid
-        vmreq.status = 'created'
+    if vmreq.status in WITH_VM:
+        # its VM and VMID are still on the cluster: only the lifecycle actions may change it
+        flash(f'VM for {vmreq.vm_name} is already {vmreq.status}')
+        return redirect(url_for('default.vm_requests'))
+    # pending and approved hold cluster capacity: a waiting, rejected or failed
+    # request gets them only if it fits, like on submission
+    if new_status in ('pending', 'approved') and vmreq.status != 'pending' and not admission.fits_cluster(vmreq):
+        vmreq.status = 'waiting'
         db.session.commit()
+        flash(f'Not enough free cluster capacity: {vmreq.vm_name} is waiting')
+        return redirect(url_for('default.vm_requests'))
+    # handle approved -> queue Proxmox VM creation on the background workers
+    if new_status == 'approved':
+        provisioning.enqueue(vmreq)
         from config import PROXMOX as _PROXMOX
         if _PROXMOX.get('disable_kvm_by_default'):
             flash('Note: KVM disabled for this VM (nested environment).')
-        flash(f'VM created for {vmreq.vm_name} (vmid {vmid})')
+        flash(f'VM creation queued for {vmreq.vm_name}')
         return redirect(url_for('default.vm_requests'))
 
     vmreq.status = new_status
     db.session.commit()
+    if new_status == 'rejected':
+        # capacity it held may let waiting requests in
+        admission.promote_waiting()
     flash(f'Status updated for {vmreq.vm_name} ({new_status})')
     return redirect(url_for('default.vm_requests'))
 
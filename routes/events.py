@@ -0,0 +1,59 @@
+from flask import Blueprint
+from flask import Response
+from flask import jsonify
+from flask import url_for
+from flask_login import login_required, current_user
+
+from config import EVENTS
+from models.connection import db
+from models.model import VMRequest
+from services.events import TooManySubscribers, broker, request_payload
+
+app = Blueprint('events', __name__)
+
+# statuses still expected to change, sent in the snapshot when a stream opens
+LIVE_STATUSES = ('pending', 'waiting', 'approved', 'creating')
+
+
+@app.route('/vm_requests')
+@login_required
+def vm_requests():
+    """Server-Sent Events stream of VM request status/IP changes.
+
+    Admins receive every request, other users their own. The stream starts
+    with the requests still in progress (and created ones without an IP yet),
+    so a reconnecting client catches up on what it missed.
+    """
+    user_id = None if current_user.has_role('admin') else current_user.id
+    try:
+        # subscribe before the snapshot: a change in between is sent twice, never lost
+        subscription = broker.subscribe(user_id)
+    except TooManySubscribers:
+        return jsonify({"error": "too many open streams"}), 503, {"Retry-After": "30"}
+
+    table = VMRequest.__table__
+    stmt = (
+        db.select(table.c.id, table.c.user_id, table.c.vm_name, table.c.vmid, table.c.status, table.c.IP)
+        .where(table.c.status.in_(LIVE_STATUSES)
+               | ((table.c.status == 'created') & (table.c.IP.is_(None) | (table.c.IP == 'None'))))
+        .order_by(table.c.id.desc())
+        .limit(EVENTS.get('snapshot_limit', 500))
+    )
+    if user_id is not None:
+        stmt = stmt.where(table.c.user_id == user_id)
+    snapshot = [('vm_request', request_payload(row)) for row in db.session.execute(stmt)]
+    # the stream may stay open for hours: give the connection back to the pool now
+    db.session.close()
+
+    # the generator needs no request context, so none is kept alive for it
+    return Response(broker.stream(subscription, snapshot), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # nginx would otherwise buffer the stream
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@app.app_context_processor
+def _events_url():
+    # templates only open a stream when this blueprint is registered
+    return {'vm_request_events_url': url_for('events.vm_requests')}
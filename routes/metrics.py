@@ -0,0 +1,41 @@
+import hmac
+
+from flask import Blueprint
+from flask import Response
+from flask import request
+
+from config import METRICS
+from models.connection import db
+from models.model import VMRequest
+from utils.metrics import DB_POOL, VM_REQUESTS, registry
+
+app = Blueprint('metrics', __name__)
+
+# statuses reported as queue depth
+QUEUE_STATUSES = ('pending', 'creating')
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint (all workers' counters with METRICS['multiproc_dir'], see Registry)."""
+    token = METRICS.get('token')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('unauthorized\n', status=401, mimetype='text/plain')
+
+    counts = dict(db.session.execute(
+        db.select(VMRequest.status, db.func.count())
+        .where(VMRequest.status.in_(QUEUE_STATUSES))
+        .group_by(VMRequest.status)
+    ).all())
+    for status in QUEUE_STATUSES:
+        VM_REQUESTS.set(counts.get(status, 0), status=status)
+
+    pool = db.engine.pool
+    # only QueuePool has these; SQLite in-memory uses a single shared connection
+    if hasattr(pool, 'checkedout'):
+        DB_POOL.set(pool.checkedout(), state='checked_out')
+        DB_POOL.set(pool.checkedin(), state='idle')
+        DB_POOL.set(pool.size(), state='size')
+        DB_POOL.set(max(pool.overflow(), 0), state='overflow')
+
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
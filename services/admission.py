@@ -0,0 +1,181 @@
+import logging
+
+from sqlalchemy.exc import OperationalError
+
+from config import PLACEMENT, QUOTAS, VM_TYPES
+from models import usage
+from models.connection import db
+from models.model import ResourceUsage, VMRequest
+from services.cluster_sync import cluster_sync
+
+LOG = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+RESOURCES = ('vms', 'cpu', 'ram', 'disk')
+
+
+class QuotaExceeded(Exception):
+    """The request would take a user, role or tier over its quota."""
+
+
+class AdmissionControl:
+    """Quota and capacity checks for new VM requests, before any Proxmox work.
+
+    Usage comes from the resource_usage aggregate kept by models/usage.py, so a
+    check is one primary-key read however many VMs a user has. A request is
+    added (flushed) first and checked afterwards: the aggregate UPDATE it
+    triggers locks the rows it touches, so two requests racing for the last
+    slot of a quota cannot both pass.
+
+    Cluster capacity is the CPU/RAM/disk of the online nodes in the
+    cluster_sync snapshot times QUOTAS['capacity']; requests that do not fit
+    wait (status "waiting") and are promoted in arrival order as capacity is
+    released.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def enabled(self):
+        return QUOTAS.get('enabled', True)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['admission'] = self
+        with app.app_context():
+            try:
+                # first start after the upgrade: fill the aggregate from existing requests
+                if db.session.execute(db.select(ResourceUsage.scope_type).limit(1)).first() is None and \
+                        db.session.execute(db.select(VMRequest.id).limit(1)).first() is not None:
+                    LOG.info('Building the resource usage aggregate')
+                    usage.rebuild(db.session)
+            except OperationalError:
+                # tables not created yet (e.g. before `flask db upgrade`)
+                db.session.rollback()
+
+    def admit(self, vmreq, user):
+        """Add ``vmreq`` to the session as "pending" or "waiting" (caller commits).
+
+        Raises QuotaExceeded if one of ``user``'s quotas does not allow it; the
+        caller must then roll back.
+        """
+        vmreq.status = 'pending'
+        db.session.add(vmreq)
+        if not self.enabled:
+            return vmreq.status
+        db.session.flush()
+        # current_user is a CachedUser holding role names; a User holds Role objects
+        roles = [getattr(role, 'name', role) for role in user.roles]
+        limits = self.limits(user, vmreq.vm_tier, roles)
+        rows = self.usage(list(limits) + [usage.CLUSTER])
+        if not set(roles) & set(QUOTAS.get('exempt_roles', [])):
+            for scope, limit in limits.items():
+                row = rows.get(scope)
+                for name, value in limit.items():
+                    used = getattr(row, name) if row else 0
+                    if used > value:
+                        raise QuotaExceeded(
+                            f'{_describe(scope)} quota exceeded: {name} {used - usage.demand(vmreq.vm_tier)[name]}'
+                            f' of {value} in use')
+        if not self._fits(rows.get(usage.CLUSTER)):
+            vmreq.status = 'waiting'
+            db.session.flush()
+        return vmreq.status
+
+    def fits_cluster(self, vmreq):
+        """Whether ``vmreq``, not admitted yet, fits in the remaining cluster capacity."""
+        if not self.enabled:
+            return True
+        return self._fits(self.usage([usage.CLUSTER]).get(usage.CLUSTER), usage.demand(vmreq.vm_tier))
+
+    def promote_waiting(self):
+        """Move waiting requests to pending, oldest first, while they fit; return how many."""
+        if not self.enabled:
+            return 0
+        capacity = self.capacity()
+        promoted = 0
+        waiting = db.select(VMRequest).where(VMRequest.status == 'waiting') \
+            .order_by(VMRequest.timestamp, VMRequest.id)
+        for vmreq in db.session.execute(waiting).scalars().all():
+            # re-read after each promotion: the aggregate changes on flush
+            if not self._fits(self.usage([usage.CLUSTER]).get(usage.CLUSTER),
+                              usage.demand(vmreq.vm_tier), capacity):
+                # strict FIFO: a small request never overtakes a big one
+                break
+            vmreq.status = 'pending'
+            db.session.flush()
+            promoted += 1
+        db.session.commit()
+        if promoted:
+            LOG.info('Promoted %s waiting VM requests', promoted)
+        return promoted
+
+    def limits(self, user, vm_tier, roles):
+        """{(scope_type, scope_key): {resource: limit}} applying to a new request."""
+        limits = {}
+        user_limit = dict(QUOTAS.get('user', {}))
+        user_limit.update(QUOTAS.get('users', {}).get(user.username, {}))
+        limits[('user', str(user.id))] = user_limit
+        for name in roles:
+            if name in QUOTAS.get('role', {}):
+                limits[('role', name)] = QUOTAS['role'][name]
+        if vm_tier in QUOTAS.get('tier', {}):
+            limits[('tier', vm_tier)] = QUOTAS['tier'][vm_tier]
+        return {scope: {k: v for k, v in limit.items() if k in RESOURCES} for scope, limit in limits.items()}
+
+    def usage(self, scopes):
+        """{(scope_type, scope_key): resource_usage row} for ``scopes``, in one query."""
+        if not scopes:
+            return {}
+        # plain rows, not ORM objects: the aggregate is updated behind the session's back
+        table = ResourceUsage.__table__
+        stmt = db.select(table).where(db.tuple_(table.c.scope_type, table.c.scope_key).in_(scopes))
+        return {(row.scope_type, row.scope_key): row for row in db.session.execute(stmt)}
+
+    def capacity(self):
+        """Resources admitted requests may hold on the online nodes, None if the cluster is unknown."""
+        if cluster_sync.fetched_at == 0:
+            return None
+        ratios = QUOTAS.get('capacity', {})
+        allowed = PLACEMENT.get('nodes')
+        storages = {cfg.get('storage', PLACEMENT.get('storage', 'local-lvm')) for cfg in VM_TYPES.values()}
+        nodes = set()
+        total = {'cpu': 0, 'ram': 0, 'disk': 0}
+        resources = cluster_sync.resources()
+        for item in resources:
+            if item.get('type') == 'node' and item.get('status') == 'online' and \
+                    (not allowed or item['node'] in allowed):
+                nodes.add(item['node'])
+                total['cpu'] += int(item.get('maxcpu') or 0)
+                total['ram'] += int(item.get('maxmem') or 0) // MB
+        for item in resources:
+            if item.get('type') == 'storage' and item['node'] in nodes and item.get('storage') in storages:
+                total['disk'] += int(item.get('maxdisk') or 0) // GB
+        return {name: int(value * ratios.get(name, 1.0)) for name, value in total.items()}
+
+    def _fits(self, row, extra=None, capacity=None):
+        capacity = capacity or self.capacity()
+        if capacity is None:
+            # cluster state never read: do not hold requests back
+            return True
+        for name, limit in capacity.items():
+            if not limit:
+                # resource not reported (e.g. no matching storage)
+                continue
+            used = (getattr(row, name) if row else 0) + (extra or {}).get(name, 0)
+            if used > limit:
+                return False
+        return True
+
+
+def _describe(scope):
+    scope_type, scope_key = scope
+    return 'Your' if scope_type == 'user' else f'{scope_type.capitalize()} "{scope_key}"'
+
+
+admission = AdmissionControl()
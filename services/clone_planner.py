@@ -0,0 +1,199 @@
+import logging
+import threading
+
+from config import CLOUDINIT_TEMPLATES, PLACEMENT, PROXMOX, TEMPLATE_REPLICAS, VM_TYPES
+from models.connection import db
+from services import service_lock
+from services.cluster_sync import cluster_sync
+from services.vmid_pool import vmids
+
+LOG = logging.getLogger(__name__)
+
+
+class ClonePlan:
+    """How to clone one VM: which template, from which node, linked or full."""
+
+    def __init__(self, template_vmid, source_node, node, full, storage=None):
+        self.template_vmid = template_vmid
+        self.source_node = source_node
+        self.node = node
+        self.full = full
+        self.storage = storage
+
+    def __repr__(self):
+        kind = 'full' if self.full else 'linked'
+        return f'<ClonePlan {kind} {self.template_vmid}@{self.source_node} -> {self.node}>'
+
+
+class ClonePlanner:
+    """Picks the template copy and clone mode for a VM on a given node.
+
+    Each tier's template (CLOUDINIT_TEMPLATES) is replicated as a template on
+    every node, named after TEMPLATE_REPLICAS['name'], so a clone reads a
+    disk on the node it writes to. With a local copy the tier's "clone" mode
+    from VM_TYPES applies; without one the VM is a full clone over the network
+    from the original template and a background thread creates the missing
+    replica, one full clone and template conversion at a time.
+
+    Replication holds the "template_replicas" service lock, so with every
+    gunicorn worker running the thread (or `flask replicate-templates` next
+    to them) a replica is never cloned twice; replica ids come from the VMID
+    pool like every other VM the app creates.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._missing = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def enabled(self):
+        return TEMPLATE_REPLICAS.get('enabled', True)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['clone_planner'] = self
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='template-replicas', daemon=True)
+            self._thread.start()
+            # check every node once right away
+            self._wakeup.set()
+
+    def plan(self, vm_tier, node):
+        """Return the ClonePlan for a ``vm_tier`` VM on ``node``."""
+        cfg = VM_TYPES[vm_tier]
+        storage = cfg.get('storage', PLACEMENT.get('storage', 'local-lvm'))
+        copies = self.templates(vm_tier)
+        if node in copies:
+            if cfg.get('clone', 'full') == 'linked':
+                return ClonePlan(copies[node], node, node, full=False)
+            return ClonePlan(copies[node], node, node, full=True, storage=storage)
+        template_vmid = CLOUDINIT_TEMPLATES[vm_tier]
+        # no copy on the target: full clone across nodes from the original
+        source_node = self._node_of(template_vmid) or node
+        if self.enabled:
+            with self._lock:
+                self._missing.add((vm_tier, node))
+            self._wakeup.set()
+        return ClonePlan(template_vmid, source_node, node, full=True, storage=storage)
+
+    def templates(self, vm_tier):
+        """{node: template vmid} of the copies of ``vm_tier``'s template on the cluster."""
+        template_vmid = CLOUDINIT_TEMPLATES.get(vm_tier)
+        if not template_vmid:
+            return {}
+        copies = dict(TEMPLATE_REPLICAS.get('known', {}).get(vm_tier, {}))
+        vms = cluster_sync.vm_status()
+        original = vms.get(int(template_vmid))
+        if original is None:
+            return copies
+        copies.setdefault(original['node'], int(template_vmid))
+        for vmid, item in vms.items():
+            if item.get('template') and item.get('name') == self.replica_name(original.get('name'), item['node']):
+                copies.setdefault(item['node'], vmid)
+        return copies
+
+    def replica_name(self, template_name, node):
+        return TEMPLATE_REPLICAS.get('name', '{template}-{node}').format(template=template_name, node=node)
+
+    def ensure_replicas(self, vm_tier=None, nodes=None):
+        """Create the missing template replicas (of ``vm_tier``, on ``nodes``); return how many."""
+        if not service_lock.acquire('template_replicas', self._lock_ttl()):
+            LOG.info('Template replication already running in another process')
+            return 0
+        try:
+            # a fresh listing: replicas made by the previous holder must show up
+            if not cluster_sync.refresh():
+                return 0
+            return self._ensure_replicas(vm_tier, nodes)
+        finally:
+            service_lock.release('template_replicas')
+
+    def _ensure_replicas(self, vm_tier, nodes):
+        nodes = nodes or self._online_nodes()
+        # a replica still being cloned is not a template yet but must not be cloned twice
+        named = {(item['node'], item.get('name')) for item in cluster_sync.vm_status().values()}
+        created = 0
+        for tier in [vm_tier] if vm_tier else list(CLOUDINIT_TEMPLATES):
+            copies = self.templates(tier)
+            original = cluster_sync.vm_status().get(int(CLOUDINIT_TEMPLATES[tier]))
+            for node in nodes:
+                if node in copies:
+                    continue
+                if original and (node, self.replica_name(original.get('name'), node)) in named:
+                    continue
+                # one clone may take most of the ttl: renew before each
+                if not service_lock.acquire('template_replicas', self._lock_ttl()):
+                    LOG.warning('Lost the template replication lock, stopping')
+                    return created
+                if self._replicate(tier, node):
+                    created += 1
+        if created:
+            cluster_sync.refresh()
+        return created
+
+    def _replicate(self, vm_tier, node):
+        from proxmox_api import clone_template, convert_to_template
+
+        template_vmid = int(CLOUDINIT_TEMPLATES[vm_tier])
+        original = cluster_sync.vm_status().get(template_vmid)
+        if original is None:
+            LOG.warning('Template %s of tier %s not found on the cluster', template_vmid, vm_tier)
+            return False
+        # from the pool, not cluster.nextid: never the id another process is about to use;
+        # the replica on the cluster keeps the pool from handing the id out again
+        vmid = vmids.allocate()
+        name = self.replica_name(original.get('name'), node)
+        storage = VM_TYPES[vm_tier].get('storage', PLACEMENT.get('storage', 'local-lvm'))
+        LOG.info('Replicating template %s to %s as %s (%s)', template_vmid, node, vmid, name)
+        try:
+            status = clone_template(vm_tier, vmid, name, node, source_node=original['node'],
+                                    full=True, template_vmid=template_vmid, storage=storage)
+        except Exception:
+            LOG.exception('Could not replicate template %s to %s', template_vmid, node)
+            status = None
+        if not status or status.get('exitstatus') != 'OK':
+            LOG.error('Could not replicate template %s to %s: %s', template_vmid, node, status)
+            vmids.release(vmid)
+            return False
+        convert_to_template(vmid, node)
+        return True
+
+    def _online_nodes(self):
+        allowed = PLACEMENT.get('nodes')
+        return [item['node'] for item in cluster_sync.resources()
+                if item.get('type') == 'node' and item.get('status') == 'online'
+                and (not allowed or item['node'] in allowed)]
+
+    def _lock_ttl(self):
+        return PROXMOX.get('task_timeout', 300) + 60
+
+    def _node_of(self, vmid):
+        item = cluster_sync.vm_status().get(int(vmid))
+        return item['node'] if item else None
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(TEMPLATE_REPLICAS.get('interval', 3600))
+            self._wakeup.clear()
+            with self._lock:
+                missing, self._missing = self._missing, set()
+            with self.app.app_context():
+                try:
+                    if missing:
+                        for vm_tier, node in sorted(missing):
+                            self.ensure_replicas(vm_tier, [node])
+                    else:
+                        self.ensure_replicas()
+                except Exception:
+                    db.session.rollback()
+                    LOG.exception('Template replication failed')
+                finally:
+                    db.session.remove()
+
+
+clone_planner = ClonePlanner()
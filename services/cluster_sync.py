@@ -0,0 +1,69 @@
+import logging
+import threading
+import time
+
+from config import CLUSTER_SYNC
+
+LOG = logging.getLogger(__name__)
+
+
+class ClusterSync:
+    """In-memory snapshot of /cluster/resources refreshed by a background thread.
+
+    One bulk call every CLUSTER_SYNC['interval'] seconds replaces per-VM status
+    lookups: pages join the snapshot onto VMRequest rows by vmid and the
+    placement engine reads node and storage usage from it.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._resources = []
+        self._vms = {}
+        self._fetched_at = 0
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['cluster_sync'] = self
+        if CLUSTER_SYNC.get('enabled', True) and self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='cluster-sync', daemon=True)
+            self._thread.start()
+
+    @property
+    def fetched_at(self):
+        """time.monotonic() of the last successful refresh (0 if never)."""
+        return self._fetched_at
+
+    def resources(self, max_age=None):
+        """Return the raw resource list, refreshing it first if older than ``max_age``."""
+        if max_age is not None and time.monotonic() - self._fetched_at > max_age:
+            self.refresh()
+        return self._resources
+
+    def vm_status(self):
+        """Return {vmid: resource entry} for every VM on the cluster."""
+        return self._vms
+
+    def refresh(self):
+        from proxmox_api import get_proxmox
+
+        try:
+            resources = get_proxmox().cluster.resources.get() or []
+        except Exception:
+            LOG.exception('Cluster resource sync failed')
+            return False
+        vms = {int(item['vmid']): item for item in resources if item.get('type') in ('qemu', 'lxc')}
+        with self._lock:
+            self._resources = resources
+            self._vms = vms
+            self._fetched_at = time.monotonic()
+        return True
+
+    def _loop(self):
+        while True:
+            self.refresh()
+            time.sleep(CLUSTER_SYNC.get('interval', 10))
+
+
+cluster_sync = ClusterSync()
@@ -0,0 +1,194 @@
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from config import EVENTS
+from models.connection import db
+from models.model import VMRequest
+
+LOG = logging.getLogger(__name__)
+
+
+class TooManySubscribers(Exception):
+    """EVENTS['max_subscribers'] streams are already open in this process."""
+
+
+class Subscription:
+    """Bounded queue of events for one open stream."""
+
+    def __init__(self, user_id):
+        # None receives the events of every user (admins)
+        self.user_id = user_id
+        self.queue = queue.Queue(EVENTS.get('queue_size', 100))
+        # set when events were dropped; the stream then ends and the client
+        # reconnects, getting a fresh snapshot
+        self.overflowed = False
+
+
+class EventBroker:
+    """Publish/subscribe for VMRequest changes, streamed as Server-Sent Events.
+
+    Changes made through the ORM are collected during the flush and
+    published after the commit, so a rolled back change is never seen.
+    Publishing is a put_nowait() per matching subscriber and costs nothing
+    without subscribers. A waiting stream blocks on its own queue with a
+    EVENTS['heartbeat'] timeout: with the default gevent workers (see
+    gunicorn.conf.py) that is a greenlet per client, with gthread workers a
+    thread, so there EVENTS['max_subscribers'] stays well below the worker's
+    threads.
+
+    Without EVENTS['redis_url'] events only reach the streams of the process
+    that made the change. With it, every event goes through one Redis
+    pub/sub channel and a listener thread per process hands it to the local
+    streams, so changes made by any worker, the provisioning threads or the
+    CLI reach every client. A client reconnecting (EventSource does it by
+    itself) starts with a snapshot of the requests still in progress.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._ids = itertools.count(1)
+        self._redis = None
+        self._listen_client = None
+        self._listener = None
+
+    @property
+    def has_subscribers(self):
+        """Whether a published event can reach any stream (always with Redis)."""
+        return self._redis is not None or bool(self._subscribers)
+
+    def init_app(self, app):
+        app.extensions['events'] = self
+        url = EVENTS.get('redis_url')
+        if url and self._redis is None:
+            try:
+                import redis
+            except ImportError:
+                LOG.warning('EVENTS redis_url is set but the redis package is not installed; '
+                            'events reach the streams of their own process only')
+                return
+            self._redis = redis.Redis.from_url(url, socket_timeout=1)
+            # a quiet channel is normal: no read timeout on the subscriber
+            self._listen_client = redis.Redis.from_url(url, socket_keepalive=True)
+
+    def subscribe(self, user_id=None):
+        with self._lock:
+            if len(self._subscribers) >= EVENTS.get('max_subscribers', 1000):
+                raise TooManySubscribers()
+            subscription = Subscription(user_id)
+            self._subscribers.add(subscription)
+            if self._redis is not None and self._listener is None:
+                # started by the first stream: CLI commands only ever publish
+                self._listener = threading.Thread(target=self._listen, name='events-listener', daemon=True)
+                self._listener.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, kind, data, user_id=None):
+        """Send ``data`` to the subscribers allowed to see ``user_id``'s requests."""
+        if self._redis is not None:
+            try:
+                self._redis.publish(EVENTS.get('redis_channel', 'codice:events'),
+                                    json.dumps([kind, data, user_id], separators=(',', ':')))
+                return
+            except Exception:
+                LOG.exception('Could not publish event to Redis, delivering it locally only')
+        self._dispatch(kind, data, user_id)
+
+    def _dispatch(self, kind, data, user_id):
+        if not self._subscribers:
+            return
+        message = (next(self._ids), kind, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if subscription.user_id is not None and subscription.user_id != user_id:
+                continue
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                subscription.overflowed = True
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._listen_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(EVENTS.get('redis_channel', 'codice:events'))
+                for message in pubsub.listen():
+                    self._dispatch(*json.loads(message['data']))
+            except Exception:
+                LOG.exception('Event listener lost Redis, reconnecting')
+            # events may have been missed: streams end and reconnect with a snapshot
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for subscription in subscribers:
+                subscription.overflowed = True
+            time.sleep(1)
+
+    def publish_requests(self, rows):
+        """Publish the current state of VMRequest objects or rows (see request_payload)."""
+        for row in rows:
+            self.publish('vm_request', request_payload(row), row.user_id)
+
+    def stream(self, subscription, initial=()):
+        """Generator of the SSE text for ``subscription``, starting with the ``initial`` events."""
+        heartbeat = EVENTS.get('heartbeat', 15)
+        try:
+            yield f"retry: {EVENTS.get('retry_ms', 5000)}\n\n"
+            for kind, data in initial:
+                yield _format(None, kind, data)
+            while not subscription.overflowed:
+                try:
+                    message = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    # comment line: keeps proxies from closing an idle connection
+                    yield ': ping\n\n'
+                    continue
+                yield _format(*message)
+        finally:
+            self.unsubscribe(subscription)
+
+
+def request_payload(row):
+    return {'id': row.id, 'vm_name': row.vm_name, 'vmid': row.vmid, 'status': row.status, 'ip': row.IP}
+
+
+def _format(event_id, kind, data):
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {kind}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+broker = EventBroker()
+
+
+@event.listens_for(VMRequest, 'after_insert')
+@event.listens_for(VMRequest, 'after_update')
+def _request_changed(mapper, connection, target):
+    if not broker.has_subscribers:
+        return
+    state = inspect(target)
+    if not any(state.attrs[name].history.has_changes() for name in ('status', 'IP', 'vmid')):
+        return
+    session = object_session(target) or db.session()
+    session.info.setdefault('vm_request_events', {})[target.id] = (request_payload(target), target.user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_after_commit(session):
+    for payload, user_id in session.info.pop('vm_request_events', {}).values():
+        broker.publish('vm_request', payload, user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('vm_request_events', None)
@@ -0,0 +1,202 @@
+import datetime
+import logging
+import threading
+import time
+
+from config import LEASES, VM_TYPES
+from models.connection import db
+from models.model import VMRequest
+from services.cluster_sync import cluster_sync
+from services.events import broker
+from services.lifecycle import lifecycle
+
+LOG = logging.getLogger(__name__)
+
+
+class LeaseReaper:
+    """Expires created VMs when their lease ends and reclaims their capacity.
+
+    A VM gets a lease on creation (VM_TYPES[tier]['lifetime_days'], or
+    whatever an admin set on the request). Every LEASES['interval'] seconds
+    the reaper reads the due leases through the expires_at index:
+
+    * "created" VMs past their lease are stopped and become "expired", with a
+      new expiry LEASES['grace_days'] later;
+    * "expired" VMs past the grace period are destroyed ("deleted"), which
+      releases their VMID, quota and node capacity (services/lifecycle.py).
+
+    A VM that used no CPU and no network for LEASES['idle_days'] (sampled
+    from the cluster_sync snapshot) has its lease cut short. Each step is
+    claimed with a conditional UPDATE, so several processes running the
+    reaper never act on the same VM twice.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._thread = None
+        self._samples = {}
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def enabled(self):
+        return LEASES.get('enabled', True)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['leases'] = self
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='lease-reaper', daemon=True)
+            self._thread.start()
+
+    def expiry(self, vm_tier, now=None):
+        """End of the lease of a ``vm_tier`` VM created at ``now`` (None = no expiry)."""
+        days = VM_TYPES.get(vm_tier, {}).get('lifetime_days')
+        if not days:
+            return None
+        return (now or _utcnow()) + datetime.timedelta(days=days)
+
+    def run_once(self):
+        """One pass of the reaper; return (stopped, destroyed) counts."""
+        now = _utcnow()
+        self.assign_missing(now)
+        self.detect_idle(now)
+        return self.expire_due(now), self.destroy_due(now)
+
+    def assign_missing(self, now):
+        # VMs created before leases existed get one from now on
+        for vm_tier in VM_TYPES:
+            expires_at = self.expiry(vm_tier, now)
+            if expires_at is None:
+                continue
+            db.session.execute(
+                db.update(VMRequest)
+                .where(VMRequest.status == 'created', VMRequest.expires_at.is_(None), VMRequest.vm_tier == vm_tier)
+                .values(expires_at=expires_at)
+            )
+        db.session.commit()
+
+    def detect_idle(self, now):
+        """Track idle_since from CPU and network counters; expire VMs idle for idle_days."""
+        idle_days = LEASES.get('idle_days')
+        fetched_at = cluster_sync.fetched_at
+        if not idle_days or fetched_at == 0:
+            return
+        live = cluster_sync.vm_status()
+        rows = db.session.execute(
+            db.select(VMRequest.vmid, VMRequest.idle_since)
+            .where(VMRequest.status == 'created', VMRequest.vmid.is_not(None))
+        ).all()
+        became_idle, became_active, samples = [], [], {}
+        for vmid, idle_since in rows:
+            item = live.get(vmid)
+            if item is None:
+                continue
+            traffic = int(item.get('netin') or 0) + int(item.get('netout') or 0)
+            samples[vmid] = (traffic, fetched_at)
+            previous = self._samples.get(vmid)
+            if previous is None or fetched_at <= previous[1]:
+                # rates need two different snapshots
+                continue
+            rate = (traffic - previous[0]) / (fetched_at - previous[1])
+            idle = item.get('status') != 'running' or (
+                float(item.get('cpu') or 0) < LEASES.get('idle_cpu', 0.02)
+                and rate < LEASES.get('idle_net_bps', 2048))
+            if idle and idle_since is None:
+                became_idle.append(vmid)
+            elif not idle and idle_since is not None:
+                became_active.append(vmid)
+        self._samples = samples
+        if became_idle:
+            db.session.execute(db.update(VMRequest).where(VMRequest.vmid.in_(became_idle))
+                               .values(idle_since=now))
+        if became_active:
+            db.session.execute(db.update(VMRequest).where(VMRequest.vmid.in_(became_active))
+                               .values(idle_since=None))
+        cutoff = now - datetime.timedelta(days=idle_days)
+        result = db.session.execute(
+            db.update(VMRequest)
+            .where(VMRequest.status == 'created', VMRequest.idle_since <= cutoff,
+                   VMRequest.expires_at.is_(None) | (VMRequest.expires_at > now))
+            .values(expires_at=now)
+        )
+        db.session.commit()
+        if result.rowcount:
+            LOG.info('%s VMs idle for %s days, expiring them now', result.rowcount, idle_days)
+
+    def expire_due(self, now):
+        """Stop created VMs whose lease ended; return how many."""
+        grace = datetime.timedelta(days=LEASES.get('grace_days', 7))
+        vmreqs = self._claim(('created',), 'expired', now, now + grace)
+        if not vmreqs:
+            return 0
+        LOG.info('Lease expired for %s VMs, stopping them', len(vmreqs))
+        results = lifecycle.run('stop', vmreqs)
+        for req_id, error in results.items():
+            if error:
+                # still destroyed at the end of the grace period
+                LOG.warning('Could not stop expired VM request %s: %s', req_id, error)
+        return len(vmreqs)
+
+    def destroy_due(self, now):
+        """Destroy expired VMs past their grace period; return how many."""
+        # a "deleting" claim whose process died is taken over after an hour
+        vmreqs = self._claim(('expired', 'deleting'), 'deleting', now, now + datetime.timedelta(hours=1))
+        if not vmreqs:
+            return 0
+        LOG.info('Grace period over for %s VMs, destroying them', len(vmreqs))
+        results = lifecycle.run('destroy', vmreqs)
+        retry_at = now + datetime.timedelta(seconds=LEASES.get('interval', 300))
+        failed = [vmreq for vmreq in vmreqs if results.get(vmreq.id)]
+        for vmreq in failed:
+            LOG.warning('Could not destroy expired VM %s: %s', vmreq.vmid, results[vmreq.id])
+            vmreq.status, vmreq.expires_at = 'expired', retry_at
+        db.session.commit()
+        return len(vmreqs) - len(failed)
+
+    def _claim(self, statuses, new_status, now, expires_at):
+        """Move due leases from ``statuses`` to ``new_status`` one by one; return the ones won."""
+        due = db.session.execute(
+            db.select(VMRequest.id)
+            .where(VMRequest.expires_at <= now, VMRequest.status.in_(statuses))
+            .order_by(VMRequest.expires_at)
+            .limit(LEASES.get('batch', 50))
+        ).scalars().all()
+        claimed = []
+        for req_id in due:
+            # these statuses hold the same quota and capacity, so a plain
+            # UPDATE (no ORM events) leaves resource_usage right; moving
+            # expires_at makes the claim exclusive
+            result = db.session.execute(
+                db.update(VMRequest)
+                .where(VMRequest.id == req_id, VMRequest.status.in_(statuses), VMRequest.expires_at <= now)
+                .values(status=new_status, expires_at=expires_at)
+            )
+            if result.rowcount:
+                claimed.append(req_id)
+        db.session.commit()
+        if not claimed:
+            return []
+        vmreqs = db.session.execute(db.select(VMRequest).where(VMRequest.id.in_(claimed))).scalars().all()
+        # the claim UPDATE fires no ORM events either
+        broker.publish_requests(vmreqs)
+        return vmreqs
+
+    def _loop(self):
+        while True:
+            time.sleep(LEASES.get('interval', 300))
+            with self.app.app_context():
+                try:
+                    self.run_once()
+                except Exception:
+                    db.session.rollback()
+                    LOG.exception('Lease reaper pass failed')
+                finally:
+                    db.session.remove()
+
+
+def _utcnow():
+    return datetime.datetime.utcnow()
+
+
+leases = LeaseReaper()
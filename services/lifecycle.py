@@ -0,0 +1,228 @@
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures import wait
+
+from config import LIFECYCLE, PROXMOX
+from models.connection import db
+from models.model import User, VMRequest
+from services.admission import admission
+from services.cluster_sync import cluster_sync
+from services.vmid_pool import vmids
+
+LOG = logging.getLogger(__name__)
+
+ACTIONS = ('start', 'shutdown', 'stop', 'destroy')
+
+# node-wide bulk endpoint for an action, None where Proxmox has none
+BULK = {'start': 'startall', 'stop': 'stopall', 'shutdown': None, 'destroy': None}
+
+# power state a VM is in after the action succeeded
+EXPECTED = {'start': 'running', 'shutdown': 'stopped', 'stop': 'stopped'}
+
+# request statuses that still own a VM and a VMID on the cluster
+WITH_VM = ('creating', 'created', 'expired', 'deleting')
+
+UNAVAILABLE = 'Could not read the cluster state'
+
+
+class LifecycleManager:
+    """Start, shut down, stop or destroy many VMs at once.
+
+    VMs are grouped by node. Start and stop use one ``startall``/``stopall``
+    task per node with the VMIDs in ``vms=`` (LIFECYCLE['bulk_chunk'] per
+    task); shutdown and destroy have no bulk endpoint and are issued as
+    individual calls, at most LIFECYCLE['parallel'] at a time. Every task is
+    waited for through the shared TaskTracker rather than a thread per VM.
+    Running VMs are stopped in bulk before being destroyed; destroyed
+    requests become "deleted" and give their VMID and quota back.
+
+    Operations started from the web UI run one at a time on a background
+    thread (submit()); run() does the work synchronously.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['lifecycle'] = self
+
+    def select(self, user=None, tier=None, older_than=None, ids=None, statuses=('created', 'expired')):
+        """Statement selecting the requests with a VM matching the given filters.
+
+        ``user`` is a username, ``older_than`` a timedelta on the request time.
+        """
+        stmt = db.select(VMRequest).where(VMRequest.vmid.is_not(None), VMRequest.status.in_(statuses))
+        if ids:
+            stmt = stmt.where(VMRequest.id.in_(ids))
+        if user:
+            stmt = stmt.where(VMRequest.user_id == db.select(User.id).where(User.username == user).scalar_subquery())
+        if tier:
+            stmt = stmt.where(VMRequest.vm_tier == tier)
+        if older_than:
+            stmt = stmt.where(VMRequest.timestamp < datetime.datetime.utcnow() - older_than)
+        return stmt.order_by(VMRequest.id)
+
+    def submit(self, action, request_ids):
+        """Run ``action`` on ``request_ids`` in the background; return at once."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lifecycle')
+        return self._executor.submit(self._run_in_context, action, list(request_ids))
+
+    def _run_in_context(self, action, request_ids):
+        with self.app.app_context():
+            try:
+                vmreqs = db.session.execute(self.select(ids=request_ids)).scalars().all()
+                return self.run(action, vmreqs)
+            except Exception:
+                LOG.exception('Bulk %s of %s VM requests failed', action, len(request_ids))
+                raise
+            finally:
+                db.session.remove()
+
+    def run(self, action, vmreqs):
+        """Apply ``action`` to ``vmreqs``; return {request id: error text or None}."""
+        if action not in ACTIONS:
+            raise ValueError(f'Unknown action {action}')
+        results = {}
+        targets = []
+        # fresh power states: deleting a VM still running fails
+        live = self._live()
+        if live is None:
+            # a VM missing from a stale snapshot is not a VM gone: touch nothing
+            LOG.error('Bulk %s of %s VMs aborted: cluster state unavailable', action, len(vmreqs))
+            return {vmreq.id: UNAVAILABLE for vmreq in vmreqs}
+        for vmreq in vmreqs:
+            item = live.get(vmreq.vmid)
+            if item is None:
+                # already gone from the cluster (deleted by hand)
+                results[vmreq.id] = None if action == 'destroy' else 'VM not found on the cluster'
+                continue
+            targets.append((vmreq, item['node'], item.get('status')))
+        LOG.info('Bulk %s of %s VMs', action, len(targets))
+        if action == 'destroy':
+            running = [(vmreq, node, state) for vmreq, node, state in targets if state != 'stopped']
+            results.update(self._bulk('stopall', running))
+            targets = [t for t in targets if results.get(t[0].id) is None]
+            results.update(self._each('destroy', targets))
+            self._mark_deleted([vmreq for vmreq in vmreqs if results.get(vmreq.id) is None])
+        elif BULK[action]:
+            results.update(self._bulk(BULK[action], [t for t in targets if t[2] != EXPECTED[action]]))
+        else:
+            results.update(self._each(action, [t for t in targets if t[2] != EXPECTED[action]]))
+        for vmreq in vmreqs:
+            results.setdefault(vmreq.id, None)
+        if action != 'destroy':
+            self._verify(action, vmreqs, results)
+        failed = sum(1 for error in results.values() if error)
+        LOG.info('Bulk %s done: %s ok, %s failed', action, len(results) - failed, failed)
+        return results
+
+    def _bulk(self, endpoint, targets):
+        """One startall/stopall task per node and chunk of VMs."""
+        from proxmox_api import start_bulk, tasks
+
+        by_node = {}
+        for vmreq, node, _ in targets:
+            by_node.setdefault(node, []).append(vmreq)
+        chunk = LIFECYCLE.get('bulk_chunk', 50)
+        batches = [(node, group[i:i + chunk]) for node, group in by_node.items() for i in range(0, len(group), chunk)]
+        results, futures = {}, {}
+        for node, group in batches:
+            try:
+                upid = start_bulk(node, endpoint, [vmreq.vmid for vmreq in group])
+            except Exception as e:
+                LOG.exception('%s on node %s failed', endpoint, node)
+                results.update({vmreq.id: str(e) for vmreq in group})
+                continue
+            futures[tasks.track(upid, node=node, timeout=self._timeout(len(group)))] = group
+        results.update(self._collect(futures))
+        return results
+
+    def _each(self, action, targets):
+        """One call per VM, at most LIFECYCLE['parallel'] in flight."""
+        from proxmox_api import start_destroy, start_power, tasks
+
+        def issue(vmid, node):
+            if action == 'destroy':
+                return start_destroy(vmid, node)
+            return start_power(vmid, node, action)
+
+        results, futures = {}, {}
+        with ThreadPoolExecutor(max_workers=LIFECYCLE.get('parallel', 8), thread_name_prefix='lifecycle-call') as pool:
+            calls = {pool.submit(issue, vmreq.vmid, node): (vmreq, node) for vmreq, node, _ in targets}
+            for call, (vmreq, node) in calls.items():
+                try:
+                    upid = call.result()
+                except Exception as e:
+                    if action == 'destroy' and getattr(e, 'status_code', None) == 404:
+                        # removed since the listing: nothing left to destroy
+                        results[vmreq.id] = None
+                        continue
+                    LOG.error('%s of VM %s failed: %s', action, vmreq.vmid, e)
+                    results[vmreq.id] = str(e)
+                    continue
+                futures[tasks.track(upid, node=node, timeout=self._timeout(1))] = [vmreq]
+        results.update(self._collect(futures))
+        return results
+
+    def _collect(self, futures):
+        results = {}
+        wait(futures)
+        for future, group in futures.items():
+            try:
+                status = future.result()
+                error = None if status.get('exitstatus') == 'OK' else f"task failed: {status.get('exitstatus')}"
+            except (TimeoutError, FutureTimeout) as e:
+                error = str(e)
+            for vmreq in group:
+                results[vmreq.id] = error
+        return results
+
+    def _verify(self, action, vmreqs, results):
+        # a bulk task can end OK with single VMs failing: check the power state
+        live = self._live()
+        for vmreq in vmreqs:
+            if results[vmreq.id] is not None:
+                continue
+            if live is None:
+                results[vmreq.id] = UNAVAILABLE
+                continue
+            item = live.get(vmreq.vmid)
+            if item is None:
+                results[vmreq.id] = 'VM not found on the cluster'
+            elif item.get('status') != EXPECTED[action]:
+                results[vmreq.id] = f"VM is {item.get('status')}"
+
+    def _mark_deleted(self, vmreqs):
+        if not vmreqs:
+            return
+        released = [vmreq.vmid for vmreq in vmreqs if vmreq.vmid is not None]
+        for vmreq in vmreqs:
+            vmreq.status, vmreq.vmid, vmreq.node, vmreq.expires_at = 'deleted', None, None, None
+        db.session.commit()
+        vmids.release_many(released)
+        cluster_sync.refresh()
+        # the quota and capacity they held may let waiting requests in
+        admission.promote_waiting()
+
+    def _live(self):
+        """Freshly listed {vmid: resource entry}, None if the listing failed."""
+        if not cluster_sync.refresh():
+            return None
+        return cluster_sync.vm_status()
+
+    def _timeout(self, count):
+        # a bulk task handles its VMs one after the other
+        return PROXMOX.get('task_timeout', 300) + LIFECYCLE.get('bulk_per_vm', 30) * (count - 1)
+
+
+lifecycle = LifecycleManager()
@@ -0,0 +1,167 @@
+import threading
+import time
+
+from config import PLACEMENT, PROXMOX, VM_TYPES
+from services.cluster_sync import cluster_sync
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# name -> policy function, see register_policy()
+POLICIES = {}
+
+
+class NoCapacityError(Exception):
+    """No node has room for the requested tier."""
+
+
+def register_policy(name):
+    """Register a placement policy.
+
+    A policy receives the list of candidate node dicts (only nodes the VM fits
+    on, with in-flight reservations already subtracted) and the demand dict,
+    and returns the chosen node dict.
+    """
+    def decorator(func):
+        POLICIES[name] = func
+        return func
+    return decorator
+
+
+@register_policy('least_loaded')
+def least_loaded(candidates, demand):
+    # lowest memory/CPU pressure after placing the VM
+    return min(candidates, key=lambda n: max(
+        (n['mem'] + demand['mem']) / n['maxmem'],
+        n['cpu_load'],
+    ))
+
+
+@register_policy('bin_packing')
+def bin_packing(candidates, demand):
+    # fill the fullest node that still fits, keeping others free for big tiers
+    return max(candidates, key=lambda n: (n['mem'] + demand['mem']) / n['maxmem'])
+
+
+@register_policy('spread')
+def spread(candidates, demand):
+    # fewest VMs per node
+    return min(candidates, key=lambda n: (n['vms'], n['mem'] / n['maxmem']))
+
+
+class Placement:
+    """A node chosen for one VM; counts against that node until released."""
+
+    def __init__(self, node, demand):
+        self.node = node
+        self.demand = demand
+        self.released_at = None
+
+    def __repr__(self):
+        return f'<Placement {self.node} mem={self.demand["mem"]}>'
+
+
+class PlacementEngine:
+    """Chooses a target node per VM from cached /cluster/resources data.
+
+    Node and storage usage come from the shared cluster_sync snapshot, which is
+    refreshed on demand when older than PLACEMENT['cache_ttl'] seconds.
+    Placements still being provisioned are added to the usage of their node; a
+    released placement keeps counting until the next snapshot, which by then
+    includes the new VM.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._fetched_at = 0
+        self._inflight = []
+
+    def reserve(self, vm_tier):
+        """Pick a node for a VM of ``vm_tier`` and reserve its resources there."""
+        cfg = VM_TYPES[vm_tier]
+        demand = {'cpu': cfg['cpu'], 'mem': cfg['ram'] * MB, 'disk': cfg['disk'] * GB,
+                  'storage': cfg.get('storage', PLACEMENT.get('storage', 'local-lvm'))}
+        with self._lock:
+            snapshot = self._get_snapshot()
+            if snapshot is None:
+                # cluster data unavailable: keep the old single-node behaviour
+                placement = Placement(PROXMOX.get('node', 'pve'), demand)
+            else:
+                placement = Placement(self._choose(snapshot, demand), demand)
+            self._inflight.append(placement)
+            return placement
+
+    def release(self, placement):
+        with self._lock:
+            placement.released_at = time.monotonic()
+
+    def _choose(self, snapshot, demand):
+        storage = demand['storage']
+        candidates = []
+        for name, node in snapshot['nodes'].items():
+            usage = dict(node)
+            for placement in self._inflight:
+                if placement.node == name:
+                    usage['mem'] += placement.demand['mem']
+                    usage['disk'] += placement.demand['disk']
+                    usage['vms'] += 1
+            if usage['maxmem'] - usage['mem'] < demand['mem']:
+                continue
+            store = snapshot['storage'].get(name, {}).get(storage)
+            if store is None:
+                # the clone would fail on a node without the tier's storage
+                continue
+            if store['maxdisk'] - store['disk'] - (usage['disk'] - node['disk']) < demand['disk']:
+                continue
+            candidates.append(usage)
+        if not candidates:
+            raise NoCapacityError(f'No node has {demand["mem"] // MB} MB RAM / {demand["disk"] // GB} GB free '
+                                  f'on storage {storage}')
+        policy = POLICIES[PLACEMENT.get('policy', 'least_loaded')]
+        return policy(candidates, demand)['name']
+
+    def _get_snapshot(self):
+        resources = cluster_sync.resources(max_age=PLACEMENT.get('cache_ttl', 15))
+        if cluster_sync.fetched_at == 0:
+            # cluster state never read successfully
+            return None
+        if self._snapshot is None or cluster_sync.fetched_at != self._fetched_at:
+            self._snapshot = self._build_snapshot(resources)
+            self._fetched_at = cluster_sync.fetched_at
+            # released placements are now part of the node usage we just read
+            self._inflight = [p for p in self._inflight
+                              if p.released_at is None or p.released_at > self._fetched_at]
+        return self._snapshot
+
+    def _build_snapshot(self, resources):
+        allowed = PLACEMENT.get('nodes')
+        nodes, storage, vm_nodes = {}, {}, {}
+        for item in resources or []:
+            kind = item.get('type')
+            if kind == 'node':
+                if item.get('status') != 'online' or (allowed and item['node'] not in allowed):
+                    continue
+                nodes[item['node']] = {
+                    'name': item['node'],
+                    'cpu_load': float(item.get('cpu') or 0),
+                    'maxcpu': int(item.get('maxcpu') or 0),
+                    'mem': int(item.get('mem') or 0),
+                    'maxmem': int(item.get('maxmem') or 1),
+                    'disk': 0,
+                    'vms': 0,
+                }
+            elif kind == 'storage':
+                storage.setdefault(item['node'], {})[item['storage']] = {
+                    'disk': int(item.get('disk') or 0),
+                    'maxdisk': int(item.get('maxdisk') or 0),
+                }
+            elif kind in ('qemu', 'lxc'):
+                vm_nodes[int(item['vmid'])] = item['node']
+        for vmid, node in vm_nodes.items():
+            if node in nodes:
+                nodes[node]['vms'] += 1
+        return {'nodes': nodes, 'storage': storage, 'vm_nodes': vm_nodes}
+
+
+placements = PlacementEngine()
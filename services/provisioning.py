@@ -0,0 +1,424 @@
+import datetime
+import logging
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from sqlalchemy.exc import OperationalError
+
+from config import CLOUDINIT_TEMPLATES, PROVISIONING
+from models.connection import db
+from models.model import ProvisioningJob, VMRequest
+from services import service_lock
+from services.admission import admission
+from services.clone_planner import clone_planner
+from services.leases import leases
+from services.placement import placements
+from services.vmid_pool import ClusterUnavailable, vmids
+from services.warm_pool import warm_pool
+from utils.metrics import CREATE_VM_PHASE
+
+LOG = logging.getLogger(__name__)
+
+# steps of a job, in order; ProvisioningJob.step is the next one to run
+STEPS = ('reserve', 'clone', 'wait', 'configure', 'start')
+
+
+class Interrupted(Exception):
+    """A resumed job is in a state that cannot be continued; roll it back and retry."""
+
+
+class Abandoned(Exception):
+    """The job was requeued and claimed again: this run no longer owns it."""
+
+
+class ProvisioningQueue:
+    """Runs VM creations for approved requests on a pool of background threads.
+
+    Jobs are persisted in the provisioning_job table before being handed to the
+    pool, so the approving HTTP request only pays for one INSERT/UPDATE and jobs
+    still queued when the process stops are picked up again on the next start.
+
+    A creation is a sequence of steps (see STEPS) and the job row is updated
+    after each one with what it produced (VMID and node, then the clone UPID),
+    plus a heartbeat while it waits for a node slot or a task. Every
+    PROVISIONING['reconcile_interval'] seconds (and at startup), jobs whose
+    worker stopped beating for PROVISIONING['stale_after'] seconds are
+    requeued and continue from their last step: a clone already running is
+    waited for, not redone. Every write of a run is conditional on the job
+    still being running with the ``attempts`` value of its claim, so a run
+    whose job was requeued stops at its next write instead of racing the new
+    owner.
+
+    Every gunicorn worker runs such a pool, so the limits are slots in the
+    service_lock table shared by all the processes: a run holds one of
+    PROVISIONING['workers'] slots while it executes and one of the
+    PROVISIONING['per_node'] slots of its node while its clone runs. Slots
+    are renewed with the heartbeat and expire with it, so a process that
+    died does not keep them.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        # notified when a run of this process frees a slot (others are polled)
+        self.slot_freed = threading.Condition()
+        # jobs handed to this process's pool and not finished yet
+        self._submitted = set()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self._executor = ThreadPoolExecutor(
+            max_workers=PROVISIONING.get('workers', 4),
+            thread_name_prefix='provisioning',
+        )
+        app.extensions['provisioning'] = self
+        with app.app_context():
+            try:
+                self.reconcile()
+                pending = db.session.execute(
+                    db.select(ProvisioningJob.id).filter_by(status='queued')
+                ).scalars().all()
+            except OperationalError:
+                # tables not created yet (e.g. before `flask db upgrade`)
+                db.session.rollback()
+                pending = []
+        for job_id in pending:
+            self.submit(job_id)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='provisioning-reconcile', daemon=True)
+            self._thread.start()
+
+    def reconcile(self):
+        """Requeue running jobs whose worker died (no heartbeat for stale_after seconds).
+
+        Return the ids of the queued jobs nobody has touched for stale_after
+        seconds: the requeued ones and those left in the pool of a process
+        that stopped.
+        """
+        cutoff = _utcnow() - datetime.timedelta(seconds=PROVISIONING.get('stale_after', 120))
+        stale = (ProvisioningJob.status == 'running') & (
+            ProvisioningJob.heartbeat.is_(None) | (ProvisioningJob.heartbeat < cutoff))
+        requeued = []
+        for job in db.session.execute(db.select(ProvisioningJob).where(stale)).scalars().all():
+            # still stale at UPDATE time: a job beating in between stays with its worker
+            result = db.session.execute(
+                db.update(ProvisioningJob).where(ProvisioningJob.id == job.id, stale).values(status='queued'))
+            if result.rowcount:
+                LOG.warning('Resuming interrupted provisioning job %s at step %s (vmid %s)', job.id, job.step, job.vmid)
+                requeued.append(job.id)
+        orphaned = db.session.execute(
+            db.select(ProvisioningJob.id)
+            .where(ProvisioningJob.status == 'queued', ProvisioningJob.updated_at < cutoff)
+        ).scalars().all()
+        db.session.commit()
+        return sorted(set(requeued) | set(orphaned))
+
+    def enqueue(self, vmreq):
+        """Create a job for ``vmreq``, mark it as creating and schedule it."""
+        return self.enqueue_many([vmreq])[0]
+
+    def enqueue_many(self, vmreqs):
+        """Queue a job for each request with a single commit; return the jobs."""
+        jobs = []
+        for vmreq in vmreqs:
+            job = ProvisioningJob(request_id=vmreq.id, status='queued')
+            vmreq.status = 'creating'
+            db.session.add(job)
+            jobs.append(job)
+        db.session.commit()
+        for job in jobs:
+            self.submit(job.id)
+        return jobs
+
+    def submit(self, job_id):
+        with self._lock:
+            if job_id in self._submitted:
+                return
+            self._submitted.add(job_id)
+        self._executor.submit(self._run, job_id)
+
+    def _loop(self):
+        # a worker restarted by gunicorn boots before its old jobs look stale,
+        # so the startup reconcile alone would leave them running forever
+        while True:
+            time.sleep(PROVISIONING.get('reconcile_interval', 60))
+            with self.app.app_context():
+                try:
+                    job_ids = self.reconcile()
+                except Exception:
+                    db.session.rollback()
+                    LOG.exception('Provisioning reconcile failed')
+                    job_ids = []
+                finally:
+                    db.session.remove()
+            for job_id in job_ids:
+                self.submit(job_id)
+
+    def _claim(self, job_id):
+        # atomic queued -> running transition, so a job is never run twice even
+        # when several processes share the same database
+        result = db.session.execute(
+            db.update(ProvisioningJob)
+            .where(ProvisioningJob.id == job_id, ProvisioningJob.status == 'queued')
+            .values(status='running', attempts=ProvisioningJob.attempts + 1, heartbeat=_utcnow())
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            run = None
+            try:
+                # from here on a resubmission of this job is a new run
+                with self._lock:
+                    self._submitted.discard(job_id)
+                if not self._claim(job_id):
+                    return
+                job = db.session.get(ProvisioningJob, job_id)
+                vmreq = db.session.get(VMRequest, job.request_id)
+                run = ProvisioningRun(self, job, vmreq)
+                try:
+                    run.execute()
+                except Interrupted as e:
+                    LOG.warning('Rolling back provisioning job %s: %s', job_id, e)
+                    db.session.rollback()
+                    self._rollback(run, str(e), retry=True)
+                except Abandoned:
+                    raise
+                except ClusterUnavailable as e:
+                    # nothing built yet: back to the queue without using up an
+                    # attempt, reconcile submits it again after stale_after
+                    LOG.warning('Postponing provisioning job %s: %s', job_id, e)
+                    db.session.rollback()
+                    run.save(status='queued', error=str(e), attempts=run.token - 1)
+                except Exception as e:
+                    LOG.exception('Failed to create VM for request %s', vmreq.id)
+                    db.session.rollback()
+                    self._rollback(run, str(e))
+            except Abandoned:
+                # requeued by reconcile and claimed again: the new run owns the
+                # job and whatever it built, leave both alone
+                db.session.rollback()
+                LOG.warning('Provisioning job %s was taken over by another run, abandoning it', job_id)
+            except Exception:
+                LOG.exception('Provisioning job %s crashed', job_id)
+            finally:
+                if run is not None:
+                    run.release()
+                db.session.remove()
+
+    def _rollback(self, run, error, retry=False):
+        """Remove what the job built on the cluster, then fail it or queue it again."""
+        from proxmox_api import destroy_vm, wait_unlocked
+
+        job, vmreq = run.job, run.vmreq
+        # never destroy a VM that a new owner of the job is building
+        run.save()
+        if job.vmid is not None:
+            leftover = None
+            # the VM is ours only once its clone/create task was accepted (the
+            # UPID saved with step 'wait'): before that the id may be held by
+            # a VM someone else created ("already exists"), which stays
+            if job.step not in ('reserve', 'clone'):
+                try:
+                    wait_unlocked(job.vmid, job.node, beat=run.save)
+                    destroy_vm(job.vmid, job.node)
+                except Abandoned:
+                    raise
+                except Exception:
+                    LOG.exception('Could not remove VM %s of failed job %s', job.vmid, job.id)
+                    leftover = job.vmid
+            if leftover is None:
+                vmids.release(job.vmid)
+                vmreq.vmid, vmreq.node = None, None
+            else:
+                # keep the id bound to the request so the orphan is visible and not reused
+                error = f'{error} (VM {leftover} left on node {job.node})'
+                retry = False
+        if retry and job.attempts < PROVISIONING.get('max_attempts', 3):
+            run.save(error=error, step='reserve', vmid=None, node=None, source_node=None, upid=None,
+                     status='queued')
+            self.submit(job.id)
+            return
+        vmreq.status = 'error'
+        run.save(error=error, status='failed')
+        # the failed request no longer holds cluster capacity
+        admission.promote_waiting()
+
+
+class ProvisioningRun:
+    """One execution of a job: runs its remaining steps and persists each one."""
+
+    def __init__(self, queue, job, vmreq):
+        self.queue = queue
+        self.job = job
+        self.vmreq = vmreq
+        # attempts value of this run's claim, checked by every write
+        self.token = job.attempts
+        # a job picked up again after a restart (or a rollback)
+        self.resumed = job.attempts > 1
+        self.placement = None
+        # service_lock owner of this run's slots, and the slots it holds by kind
+        self.owner = f'job-{job.id}-{job.attempts}'
+        self.slots = {}
+        # generate access credentials (do NOT store them on the request)
+        self.access_user = 'root'
+        self.access_password = secrets.token_urlsafe(12)
+
+    def execute(self):
+        started = time.perf_counter()
+        self._acquire_slot('run', 'provisioning', PROVISIONING.get('workers', 4))
+        while self.job.step in STEPS:
+            getattr(self, f'step_{self.job.step}')()
+        CREATE_VM_PHASE.observe(time.perf_counter() - started, phase='total')
+
+    def save(self, **changes):
+        """Persist ``changes`` and a heartbeat; raise Abandoned if the job was taken over."""
+        # one conditional UPDATE carries the changes (the ORM copies them onto
+        # self.job); the request changes are flushed in the same transaction
+        result = db.session.execute(
+            db.update(ProvisioningJob)
+            .where(ProvisioningJob.id == self.job.id, ProvisioningJob.attempts == self.token,
+                   ProvisioningJob.status == 'running')
+            .values(heartbeat=_utcnow(), **changes)
+        )
+        if result.rowcount == 0:
+            db.session.rollback()
+            raise Abandoned(f'job {self.job.id} was requeued')
+        db.session.commit()
+        for name in self.slots.values():
+            service_lock.acquire(name, _slot_ttl(), owner=self.owner)
+
+    def release(self):
+        for kind in list(self.slots):
+            self._release_slot(kind)
+        if self.placement is not None:
+            placements.release(self.placement)
+            self.placement = None
+
+    def step_reserve(self):
+        warm = warm_pool.claim(self.vmreq.vm_tier)
+        if warm is not None:
+            # pre-cloned VM: only rename, configure and start it
+            vmids.assign(warm.vmid, self.vmreq.id)
+            vmid, node, next_step = warm.vmid, warm.node, 'configure'
+        else:
+            self.placement = placements.reserve(self.vmreq.vm_tier)
+            # an id bound by an attempt interrupted before it was saved is reused
+            vmid = vmids.bound_to(self.vmreq.id) or vmids.allocate(self.vmreq.id)
+            node, next_step = self.placement.node, 'clone'
+        # written now, not at the end, so an interrupted creation never orphans the VM
+        self.vmreq.vmid, self.vmreq.node = vmid, node
+        self.save(step=next_step, vmid=vmid, node=node)
+
+    def step_clone(self):
+        from proxmox_api import cluster_vmids, start_clone, start_create
+
+        if self.resumed and self.job.vmid in cluster_vmids():
+            # the clone may have been started but its UPID was never saved: the
+            # VM cannot be told apart from someone else's, so it is not removed
+            raise Interrupted(f'VM {self.job.vmid} exists but its clone task is unknown, left on the cluster')
+        self._acquire_node_slot()
+        vm_name, vm_tier = self.vmreq.vm_name, self.vmreq.vm_tier
+        upid = None
+        template_vmid = CLOUDINIT_TEMPLATES.get(vm_tier)
+        if template_vmid:
+            plan = clone_planner.plan(vm_tier, self.job.node)
+            self.save(source_node=plan.source_node)
+            try:
+                upid = start_clone(vm_tier, self.job.vmid, vm_name, self.job.node, source_node=plan.source_node,
+                                   full=plan.full, template_vmid=plan.template_vmid, storage=plan.storage)
+            except Exception:
+                LOG.exception('Failed to clone template %s, falling back to full create', template_vmid)
+        if upid is None:
+            upid = start_create(vm_name, vm_tier, self.job.vmid, self.job.node)
+        self.save(step='wait', upid=upid)
+
+    def step_wait(self):
+        from proxmox_api import tasks
+
+        if self.job.upid:
+            self._acquire_node_slot()
+            future = tasks.track(self.job.upid, node=self.job.node)
+            with CREATE_VM_PHASE.time(phase='task_wait'):
+                while True:
+                    try:
+                        status = future.result(timeout=PROVISIONING.get('heartbeat', 30))
+                        break
+                    except FutureTimeout:
+                        if future.done():
+                            # the tracker gave up on the task
+                            raise
+                        self.save()
+            if status.get('exitstatus') != 'OK':
+                raise RuntimeError(f"Task {self.job.upid} failed: {status.get('exitstatus')}")
+        # the VM now exists on the node: free the node slot and the in-flight placement
+        self._release_slot('node')
+        if self.placement is not None:
+            placements.release(self.placement)
+            self.placement = None
+        self.save(step='configure')
+
+    def step_configure(self):
+        from proxmox_api import configure_cloudinit
+
+        configure_cloudinit(self.job.vmid, self.job.node, ci_user=self.access_user,
+                            ci_password=self.access_password, name=self.vmreq.vm_name)
+        self.save(step='start')
+
+    def step_start(self):
+        from proxmox_api import start_vm, vm_status
+
+        if not (self.resumed and vm_status(self.job.vmid, self.job.node).get('status') == 'running'):
+            start_vm(self.job.vmid, self.job.node)
+        self.vmreq.status = 'created'
+        # the lease starts now, unless an admin already set one on the request
+        self.vmreq.expires_at = self.vmreq.expires_at or leases.expiry(self.vmreq.vm_tier)
+        self.save(step='done', status='done', error=None)
+
+    def _acquire_node_slot(self):
+        self._acquire_slot('node', f'provisioning:{self.job.node}', PROVISIONING.get('per_node', 2))
+
+    def _acquire_slot(self, kind, prefix, count):
+        """Wait for one of the ``count`` slots ``prefix:0``.. shared by every process."""
+        if kind in self.slots:
+            return
+        beat = time.monotonic()
+        while True:
+            for i in range(count):
+                name = f'{prefix}:{i}'
+                if service_lock.acquire(name, _slot_ttl(), owner=self.owner):
+                    self.slots[kind] = name
+                    return
+            # keep beating while other creations hold the slots
+            if time.monotonic() - beat >= PROVISIONING.get('heartbeat', 30):
+                self.save()
+                beat = time.monotonic()
+            with self.queue.slot_freed:
+                self.queue.slot_freed.wait(PROVISIONING.get('slot_poll', 2))
+
+    def _release_slot(self, kind):
+        name = self.slots.pop(kind, None)
+        if name is not None:
+            service_lock.release(name, owner=self.owner)
+            with self.queue.slot_freed:
+                self.queue.slot_freed.notify_all()
+
+
+def _slot_ttl():
+    # a slot outlives its holder as long as a job outlives its worker
+    return PROVISIONING.get('stale_after', 120)
+
+
+def _utcnow():
+    return datetime.datetime.utcnow()
+
+
+queue = ProvisioningQueue()
@@ -0,0 +1,45 @@
+import datetime
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from models.connection import db
+from models.model import ServiceLock
+
+# this process, as the owner of the locks it takes
+OWNER = uuid.uuid4().hex
+
+
+def acquire(name, ttl, owner=None):
+    """Take or renew the lock ``name`` for ``ttl`` seconds; return whether this process holds it.
+
+    Every gunicorn worker runs the same background threads: tasks that must
+    not run twice at once (cloning replicas, filling the warm pool) take a
+    lock first. Taking it is a conditional UPDATE, or an INSERT the primary
+    key makes exclusive, so two processes can never both win. ``owner``
+    (at most 32 characters) replaces the process when several threads of
+    one process must not share the lock.
+    """
+    owner = owner or OWNER
+    now = datetime.datetime.utcnow()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    result = db.session.execute(
+        db.update(ServiceLock)
+        .where(ServiceLock.name == name, (ServiceLock.owner == owner) | (ServiceLock.expires_at < now))
+        .values(owner=owner, expires_at=expires_at)
+    )
+    if result.rowcount == 0:
+        try:
+            with db.session.begin_nested():
+                db.session.add(ServiceLock(name=name, owner=owner, expires_at=expires_at))
+        except IntegrityError:
+            # held by another process
+            db.session.commit()
+            return False
+    db.session.commit()
+    return True
+
+
+def release(name, owner=None):
+    db.session.execute(db.delete(ServiceLock).where(ServiceLock.name == name, ServiceLock.owner == (owner or OWNER)))
+    db.session.commit()
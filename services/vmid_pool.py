@@ -0,0 +1,170 @@
+import logging
+import threading
+import uuid
+from collections import deque
+
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from config import VMID_POOL
+from models.connection import db
+from models.model import VmidReservation, VMRequest, WarmVM
+
+LOG = logging.getLogger(__name__)
+
+
+class ClusterUnavailable(Exception):
+    """The cluster's VMIDs could not be listed, so no batch is reserved."""
+
+
+class VmidAllocator:
+    """Hands out VMIDs from ranges reserved in the vmid_reservation table.
+
+    Ids are reserved VMID_POOL['batch'] at a time (the primary key makes two
+    processes unable to reserve the same id) and then handed out from memory,
+    so concurrent creations never collide and do not need cluster.nextid.
+    Ids of failed creations are released and reused by a later batch, after
+    checking they are not in use on the cluster. Without the cluster listing
+    no batch is reserved (ClusterUnavailable): an id picked from the database
+    alone may belong to a VM created outside the app.
+    """
+
+    # attempts at reserving a batch when another process wins the race
+    MAX_RETRIES = 5
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._free = deque()
+        self._owner = uuid.uuid4().hex
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['vmid_pool'] = self
+        with app.app_context():
+            try:
+                # ids reserved by previous runs but never assigned go back to the pool;
+                # a live process owning one of them just skips it when binding
+                db.session.execute(
+                    db.update(VmidReservation)
+                    .where(VmidReservation.request_id.is_(None), VmidReservation.owner != self._owner)
+                    .values(owner=None)
+                )
+                db.session.commit()
+            except OperationalError:
+                db.session.rollback()
+
+    def allocate(self, request_id=None):
+        """Return a VMID bound to ``request_id``."""
+        with self._lock:
+            while True:
+                if not self._free:
+                    self._reserve_batch()
+                vmid = self._free.popleft()
+                result = db.session.execute(
+                    db.update(VmidReservation)
+                    .where(VmidReservation.vmid == vmid, VmidReservation.owner == self._owner)
+                    .values(request_id=request_id)
+                )
+                db.session.commit()
+                if result.rowcount == 1:
+                    return vmid
+
+    def bound_to(self, request_id):
+        """The VMID already bound to ``request_id``, or None."""
+        return db.session.execute(
+            db.select(VmidReservation.vmid).filter_by(request_id=request_id).limit(1)
+        ).scalar()
+
+    def assign(self, vmid, request_id):
+        """Bind an already reserved ``vmid`` (e.g. a warm pool VM) to ``request_id``."""
+        db.session.execute(
+            db.update(VmidReservation)
+            .where(VmidReservation.vmid == vmid)
+            .values(request_id=request_id, owner=None)
+        )
+        db.session.commit()
+
+    def release(self, vmid):
+        """Give ``vmid`` back to the pool (e.g. after a failed creation or a destroy)."""
+        db.session.execute(
+            db.update(VmidReservation)
+            .where(VmidReservation.vmid == vmid)
+            .values(request_id=None, owner=None)
+        )
+        db.session.commit()
+
+    def release_many(self, vmids):
+        """Give several VMIDs back to the pool with one UPDATE."""
+        if not vmids:
+            return
+        db.session.execute(
+            db.update(VmidReservation)
+            .where(VmidReservation.vmid.in_(list(vmids)))
+            .values(request_id=None, owner=None)
+        )
+        db.session.commit()
+
+    def _reserve_batch(self):
+        for _ in range(self.MAX_RETRIES):
+            try:
+                claimed = self._try_reserve(VMID_POOL.get('batch', 20))
+            except IntegrityError:
+                # another process reserved part of the same range first
+                db.session.rollback()
+                continue
+            if not claimed:
+                raise RuntimeError('VMID pool exhausted')
+            self._free.extend(claimed)
+            return
+        raise RuntimeError('Could not reserve VMIDs, too much contention')
+
+    def _try_reserve(self, batch):
+        in_use = self._ids_in_use()
+        claimed = []
+
+        # reuse released ids first
+        released = db.session.execute(
+            db.select(VmidReservation.vmid)
+            .where(VmidReservation.owner.is_(None), VmidReservation.request_id.is_(None))
+            .order_by(VmidReservation.vmid)
+            .limit(batch)
+        ).scalars().all()
+        for vmid in released:
+            if vmid in in_use:
+                continue
+            result = db.session.execute(
+                db.update(VmidReservation)
+                .where(VmidReservation.vmid == vmid, VmidReservation.owner.is_(None),
+                       VmidReservation.request_id.is_(None))
+                .values(owner=self._owner)
+            )
+            if result.rowcount == 1:
+                claimed.append(vmid)
+
+        # then extend the reserved range
+        highest = db.session.execute(db.select(db.func.max(VmidReservation.vmid))).scalar()
+        candidate = max(highest or 0, VMID_POOL['start'] - 1) + 1
+        while len(claimed) < batch and candidate <= VMID_POOL['end']:
+            if candidate not in in_use:
+                db.session.add(VmidReservation(vmid=candidate, owner=self._owner))
+                claimed.append(candidate)
+            candidate += 1
+        db.session.commit()
+        return claimed
+
+    def _ids_in_use(self):
+        """VMIDs already taken on the cluster or by requests (one API call per batch)."""
+        from proxmox_api import cluster_vmids
+
+        in_use = set(db.session.execute(
+            db.select(VMRequest.vmid).where(VMRequest.vmid.is_not(None))
+        ).scalars())
+        in_use.update(db.session.execute(db.select(WarmVM.vmid)).scalars())
+        try:
+            in_use.update(cluster_vmids())
+        except Exception as e:
+            raise ClusterUnavailable(f'Could not list cluster VMIDs: {e}') from e
+        return in_use
+
+
+vmids = VmidAllocator()
@@ -0,0 +1,159 @@
+import logging
+import threading
+
+from config import PROXMOX, WARM_POOL
+from models.connection import db
+from models.model import WarmVM
+from services import service_lock
+from services.clone_planner import clone_planner
+from services.placement import placements
+from services.vmid_pool import vmids
+
+LOG = logging.getLogger(__name__)
+
+
+class WarmPool:
+    """Keeps WARM_POOL['size'][tier] stopped clones ready for each tier.
+
+    On approval the provisioning worker claims one, renames it, applies the
+    cloud-init credentials and starts it, which takes seconds instead of a
+    full clone. A background thread refills the pool, one clone at a time,
+    every WARM_POOL['refill_interval'] seconds or right after a claim. Every
+    gunicorn worker runs that thread; the "warm_pool" service lock makes one
+    of them refill at a time, so the pool never grows past its size. Clones
+    left half done by a process that stopped are destroyed on the cluster
+    before the next refill.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._wakeup = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def enabled(self):
+        return WARM_POOL.get('enabled', False)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['warm_pool'] = self
+        if not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._loop, name='warm-pool', daemon=True)
+        self._thread.start()
+        # fill the pool right away instead of after the first interval
+        self._wakeup.set()
+
+    def claim(self, vm_tier):
+        """Take a ready VM of ``vm_tier`` out of the pool, or return None."""
+        if not self.enabled:
+            return None
+        candidates = db.session.execute(
+            db.select(WarmVM.id).filter_by(vm_tier=vm_tier, status='ready').order_by(WarmVM.id)
+        ).scalars().all()
+        for warm_id in candidates:
+            # the DELETE is the claim: only one worker can remove the row
+            warm = db.session.get(WarmVM, warm_id)
+            if warm is None:
+                continue
+            db.session.expunge(warm)
+            result = db.session.execute(
+                db.delete(WarmVM).where(WarmVM.id == warm_id, WarmVM.status == 'ready')
+            )
+            db.session.commit()
+            if result.rowcount == 1:
+                self._wakeup.set()
+                return warm
+        return None
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(WARM_POOL.get('refill_interval', 60))
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    self.refill()
+                except Exception:
+                    LOG.exception('Warm pool refill failed')
+                finally:
+                    db.session.remove()
+
+    def refill(self):
+        if not service_lock.acquire('warm_pool', self._lock_ttl()):
+            # another process is refilling: its count includes our claims too
+            return
+        try:
+            self._drop_interrupted()
+            for vm_tier, size in WARM_POOL.get('size', {}).items():
+                count = db.session.execute(
+                    db.select(db.func.count(WarmVM.id)).filter_by(vm_tier=vm_tier)
+                ).scalar()
+                for _ in range(size - count):
+                    # renewed before each clone, which may take most of the ttl
+                    if not service_lock.acquire('warm_pool', self._lock_ttl()):
+                        return
+                    self._add(vm_tier)
+        finally:
+            service_lock.release('warm_pool')
+
+    def _drop_interrupted(self):
+        """Destroy the clones of 'cloning' rows, left by a refill that was interrupted.
+
+        Called with the lock held: a refill still running elsewhere would
+        hold it, so these clones have no process waiting for them.
+        """
+        from proxmox_api import destroy_vm, wait_unlocked
+
+        stale = db.session.execute(db.select(WarmVM).filter_by(status='cloning')).scalars().all()
+        for warm in stale:
+            LOG.warning('Destroying interrupted warm clone %s on %s', warm.vmid, warm.node)
+            try:
+                # the clone task may still be running on the node
+                wait_unlocked(warm.vmid, warm.node,
+                              beat=lambda: service_lock.acquire('warm_pool', self._lock_ttl()))
+                status = destroy_vm(warm.vmid, warm.node)
+                if status is not None and status.get('exitstatus') != 'OK':
+                    raise RuntimeError(f'destroy task ended with {status}')
+            except Exception:
+                # the row stays, the next refill tries again
+                LOG.exception('Could not destroy interrupted warm clone %s', warm.vmid)
+                db.session.rollback()
+                continue
+            db.session.delete(warm)
+            db.session.commit()
+            vmids.release(warm.vmid)
+
+    def _lock_ttl(self):
+        return PROXMOX.get('task_timeout', 300) + 60
+
+    def _add(self, vm_tier):
+        from proxmox_api import clone_template
+
+        placement = placements.reserve(vm_tier)
+        node = placement.node
+        placements.release(placement)
+        plan = clone_planner.plan(vm_tier, node)
+        vmid = vmids.allocate()
+        warm = WarmVM(vmid=vmid, vm_tier=vm_tier, node=node, status='cloning')
+        db.session.add(warm)
+        db.session.commit()
+        try:
+            task_status = clone_template(vm_tier, vmid, f'warm-{vm_tier}-{vmid}', node,
+                                         source_node=plan.source_node, full=plan.full,
+                                         template_vmid=plan.template_vmid, storage=plan.storage)
+            if not task_status or task_status.get('exitstatus') != 'OK':
+                raise RuntimeError(f'clone task ended with {task_status}')
+        except Exception:
+            LOG.exception('Could not clone warm %s VM %s', vm_tier, vmid)
+            db.session.rollback()
+            db.session.delete(warm)
+            db.session.commit()
+            vmids.release(vmid)
+            return
+        warm.status = 'ready'
+        db.session.commit()
+
+
+warm_pool = WarmPool()
@@ -0,0 +1,75 @@
+import pytest
+
+import app as appmod
+from config import PASSWORD_HASH, RATE_LIMIT
+from models.connection import db
+from models.model import ProvisioningJob, VMRequest, init_db
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # hash in-process: no worker pool for a handful of logins
+    monkeypatch.setitem(PASSWORD_HASH, 'workers', 0)
+    # every test logs in as admin: the per-account login limit would lock it out
+    monkeypatch.setitem(RATE_LIMIT, 'enabled', False)
+    flask_app = appmod.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'ENABLE_MIGRATIONS': False,
+        'START_SERVICES': False,
+    })
+    with flask_app.app_context():
+        db.create_all()
+        init_db()
+    client = flask_app.test_client()
+    response = client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'adminpassword'})
+    assert response.status_code == 200
+    client.application = flask_app
+    return client
+
+
+def _add_request(client, status, vmid):
+    with client.application.app_context():
+        vmreq = VMRequest(user_id=1, vm_name='lab', vm_tier='bronze', status=status, vmid=vmid)
+        db.session.add(vmreq)
+        db.session.commit()
+        return vmreq.id
+
+
+def _state(client, req_id):
+    with client.application.app_context():
+        vmreq = db.session.get(VMRequest, req_id)
+        jobs = db.session.execute(db.select(db.func.count()).select_from(ProvisioningJob)).scalar()
+        return vmreq.status, vmreq.vmid, jobs
+
+
+@pytest.mark.parametrize('status', ['expired', 'deleting', 'created', 'creating'])
+def test_approve_refused_while_request_holds_a_vm(client, status):
+    req_id = _add_request(client, status, 1000)
+    client.post(f'/admin/vm_requests/{req_id}/status', data={'status': 'approved'})
+    assert _state(client, req_id) == (status, 1000, 0)
+
+
+def test_bulk_approve_skips_expired_request(client):
+    req_id = _add_request(client, 'expired', 1000)
+    client.post('/admin/vm_requests/bulk_approve', data={'req_ids': [req_id]})
+    assert _state(client, req_id) == ('expired', 1000, 0)
+
+
+def test_reject_refused_while_request_holds_a_vm(client):
+    req_id = _add_request(client, 'expired', 1000)
+    client.post(f'/admin/vm_requests/{req_id}/status', data={'status': 'rejected'})
+    assert _state(client, req_id) == ('expired', 1000, 0)
+
+
+@pytest.mark.parametrize('status', ['waiting', 'rejected'])
+def test_pending_needs_cluster_capacity(client, monkeypatch, status):
+    from services.admission import admission
+
+    monkeypatch.setattr(admission, 'fits_cluster', lambda vmreq: False)
+    req_id = _add_request(client, status, None)
+    client.post(f'/admin/vm_requests/{req_id}/status', data={'status': 'pending'})
+    assert _state(client, req_id) == ('waiting', None, 0)
+
+    monkeypatch.setattr(admission, 'fits_cluster', lambda vmreq: True)
+    client.post(f'/admin/vm_requests/{req_id}/status', data={'status': 'pending'})
+    assert _state(client, req_id) == ('pending', None, 0)
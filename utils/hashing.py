@@ -0,0 +1,82 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from config import PASSWORD_HASH
+
+
+class HashingBusy(Exception):
+    """Too many password hashes are already queued; the caller should back off."""
+
+
+class PasswordHasher:
+    """Runs werkzeug password hashing in a bounded process pool.
+
+    scrypt is CPU bound and holds the GIL, so hashing inline makes every other
+    request on the worker wait behind a login. Here hashes run in
+    PASSWORD_HASH['workers'] processes; at most PASSWORD_HASH['max_pending']
+    may be queued or running, and callers waiting longer than
+    PASSWORD_HASH['queue_timeout'] seconds for a slot get HashingBusy.
+    With workers = 0 hashing stays inline. If a pool process dies (OOM
+    killer...) the pool is replaced and the hash retried once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(PASSWORD_HASH.get('max_pending', 64))
+
+    @property
+    def method(self):
+        return PASSWORD_HASH.get('method', 'scrypt:32768:8:1')
+
+    def hash(self, password):
+        return self._call(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._call(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True if ``pwhash`` was made with other parameters than PASSWORD_HASH['method']."""
+        return bool(pwhash) and pwhash.split('$', 1)[0] != self.method
+
+    def _call(self, func, *args):
+        if not PASSWORD_HASH.get('workers'):
+            return func(*args)
+        if not self._slots.acquire(timeout=PASSWORD_HASH.get('queue_timeout', 2)):
+            raise HashingBusy('password hashing queue is full')
+        try:
+            executor = self._get_executor()
+            try:
+                return executor.submit(func, *args).result()
+            except BrokenProcessPool:
+                # a broken pool refuses every later submit: start a new one
+                self._discard(executor)
+                return self._get_executor().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: never fork a process that already runs threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=PASSWORD_HASH['workers'],
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            return self._executor
+
+    def _discard(self, executor):
+        with self._lock:
+            # another thread may already have replaced it
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+hasher = PasswordHasher()
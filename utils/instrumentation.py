@@ -0,0 +1,161 @@
+import io
+import logging
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import INSTRUMENTATION
+from utils.metrics import PROXMOX_ERRORS, PROXMOX_LATENCY
+
+LOG = logging.getLogger(__name__)
+
+# only one request is profiled at a time (a profiler is per process on 3.12+)
+_profile_lock = threading.Lock()
+
+
+class RequestStats:
+    """Counters for the request being served, kept in ``g.stats``."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.proxmox_calls = 0
+        self.proxmox_time = 0.0
+        self.proxmox_slowest = None
+        self.profiler = None
+        self.profiling = False
+
+    def stop_profiler(self):
+        if self.profiler is not None and self.profiling:
+            self.profiler.disable()
+            self.profiling = False
+            _profile_lock.release()
+
+    def server_timing(self, total):
+        return (f'db;dur={self.db_time * 1000:.1f};desc="{self.db_queries} queries", '
+                f'proxmox;dur={self.proxmox_time * 1000:.1f};desc="{self.proxmox_calls} calls", '
+                f'total;dur={total * 1000:.1f}')
+
+
+def current_stats():
+    """The RequestStats of the current request, or None outside a request."""
+    return g.get('stats') if has_app_context() else None
+
+
+def init_app(app):
+    """Count queries and Proxmox calls per request and report the breakdown.
+
+    Every response gets a Server-Timing header (visible in the browser dev
+    tools) and requests slower than INSTRUMENTATION['slow_ms'] are logged with
+    their totals. With INSTRUMENTATION['profile_rate'] > 0 that fraction of
+    requests runs under cProfile and the hottest functions of the slow ones
+    are logged too.
+    """
+    if not INSTRUMENTATION.get('enabled', True):
+        return
+
+    @app.before_request
+    def _start_stats():
+        g.stats = stats = RequestStats()
+        rate = INSTRUMENTATION.get('profile_rate', 0)
+        if rate and random.random() < rate and _profile_lock.acquire(blocking=False):
+            import cProfile
+            stats.profiler = cProfile.Profile()
+            try:
+                stats.profiler.enable()
+                stats.profiling = True
+            except ValueError:
+                # another profiler (e.g. a debugger) is already active
+                stats.profiler = None
+                _profile_lock.release()
+
+    @app.after_request
+    def _report_stats(response):
+        stats = g.get('stats')
+        if stats is None:
+            return response
+        stats.stop_profiler()
+        total = time.perf_counter() - stats.started
+        if INSTRUMENTATION.get('server_timing', True):
+            response.headers['Server-Timing'] = stats.server_timing(total)
+        if total * 1000 >= INSTRUMENTATION.get('slow_ms', 500):
+            LOG.warning('Slow request %s %s: %.0f ms, %d queries (%.0f ms), %d Proxmox calls (%.0f ms, slowest %s)',
+                        request.method, request.path, total * 1000, stats.db_queries, stats.db_time * 1000,
+                        stats.proxmox_calls, stats.proxmox_time * 1000, stats.proxmox_slowest)
+            if stats.profiler is not None:
+                LOG.warning('Profile of %s %s:\n%s', request.method, request.path, _profile_report(stats.profiler))
+        return response
+
+    @app.teardown_request
+    def _stop_stats(exc):
+        # after_request is skipped when the view raises; never leave the profiler on
+        stats = g.pop('stats', None)
+        if stats is not None:
+            stats.stop_profiler()
+
+
+def _profile_report(profiler):
+    import pstats
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(INSTRUMENTATION.get('profile_top', 25))
+    return out.getvalue()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    stats = current_stats()
+    if stats is not None and started is not None:
+        stats.db_queries += 1
+        stats.db_time += time.perf_counter() - started
+
+
+# /nodes/px2/qemu/1234/clone -> /nodes/{node}/qemu/{vmid}/clone
+_ENDPOINT_PATTERNS = [
+    (re.compile(r'/nodes/[^/]+'), '/nodes/{node}'),
+    (re.compile(r'/tasks/UPID[^/]+'), '/tasks/{upid}'),
+    (re.compile(r'/(qemu|lxc)/\d+'), r'/\1/{vmid}'),
+]
+
+
+def proxmox_endpoint(url):
+    """API path of ``url`` with node names, VMIDs and UPIDs replaced by placeholders."""
+    path = urlparse(url).path
+    path = path.split('/api2/json', 1)[-1]
+    for pattern, replacement in _ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path
+
+
+def record_proxmox_call(response, *args, **kwargs):
+    """requests response hook installed on the Proxmox session (see proxmox_api).
+
+    Feeds the per-request counters, the Proxmox metrics and the slow call log.
+    """
+    elapsed = response.elapsed.total_seconds()
+    method, path = response.request.method, proxmox_endpoint(response.url)
+    endpoint = f'{method} {path}'
+    PROXMOX_LATENCY.observe(elapsed, method=method, endpoint=path)
+    if response.status_code >= 400:
+        PROXMOX_ERRORS.inc(method=method, endpoint=path, status=response.status_code)
+    stats = current_stats()
+    if stats is not None:
+        stats.proxmox_calls += 1
+        stats.proxmox_time += elapsed
+        if stats.proxmox_slowest is None or elapsed * 1000 > stats.proxmox_slowest[1]:
+            stats.proxmox_slowest = (endpoint, round(elapsed * 1000))
+    if elapsed * 1000 >= INSTRUMENTATION.get('slow_proxmox_ms', 2000):
+        LOG.warning('Slow Proxmox call %s: %.0f ms (HTTP %s)', endpoint, elapsed * 1000, response.status_code)
+    return response
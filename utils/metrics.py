@@ -0,0 +1,307 @@
+import atexit
+import bisect
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import g, request
+
+from config import METRICS
+
+LOG = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    """Base for metrics with labels; values are kept per label tuple."""
+
+    kind = None
+    # summed across processes (see Registry); gauges are the scraping process's own
+    shared = False
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, a, b):
+        return a + b
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        items = sorted((self.snapshot() if values is None else values).items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{self._format_labels(key)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+    shared = True
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    shared = True
+
+    def __init__(self, name, help, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts = list(counts)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def merge(self, a, b):
+        return [x + y for x, y in zip(a[0], b[0])], a[1] + b[1]
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block (also when it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f'{self.name}_bucket{self._format_labels(key, [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+        lines.append(f'{self.name}_count{self._format_labels(key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Metrics in the Prometheus text format (version 0.0.4).
+
+    gunicorn workers share one listening socket, so a scrape lands on any of
+    them. With METRICS['multiproc_dir'] set, every process writes its counters
+    and histograms to a file there every METRICS['flush_interval'] seconds and
+    the scraped process adds up all the files, so the series do not jump
+    between workers. Files of processes that exited are folded into one
+    archive file, so their counts never go back down.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._thread = None
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        merged = self._merged() if METRICS.get('multiproc_dir') else {}
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render(merged.get(metric.name)))
+        return '\n'.join(lines) + '\n'
+
+    def start_flushing(self):
+        """Write this process's file periodically and at exit (multiprocess mode only)."""
+        if not METRICS.get('multiproc_dir') or self._thread is not None:
+            return
+        os.makedirs(METRICS['multiproc_dir'], exist_ok=True)
+        # a file left by a dead process with our pid would be overwritten
+        with self._dir_lock():
+            self._archive([self._path(os.getpid())])
+        self._thread = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def flush(self):
+        _write_json(self._path(os.getpid()), self._shared_snapshot())
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS.get('flush_interval', 5))
+            try:
+                self.flush()
+            except OSError:
+                LOG.exception('Could not write metrics file')
+
+    def _shared_snapshot(self):
+        return {metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+                for metric in self._metrics.values() if metric.shared}
+
+    def _merged(self):
+        """{metric name: {label key: value}} of every process, this one live."""
+        directory = METRICS['multiproc_dir']
+        own = self._path(os.getpid())
+        with self._dir_lock():
+            dead = [path for path in glob.glob(os.path.join(directory, 'metrics-*.json'))
+                    if path != own and not _alive(path)]
+            self._archive(dead)
+            files = [path for path in glob.glob(os.path.join(directory, 'metrics-*.json')) if path != own]
+            data = [_read_json(path) for path in files + [os.path.join(directory, 'archive.json')]]
+        data.append(self._shared_snapshot())
+        return self._combine(data)
+
+    def _combine(self, data):
+        merged = {}
+        for snapshot in data:
+            for name, items in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                values = merged.setdefault(name, {})
+                for key, value in items:
+                    key = tuple(key)
+                    values[key] = metric.merge(values[key], value) if key in values else value
+        return merged
+
+    def _archive(self, paths):
+        """Fold the files at ``paths`` into archive.json and delete them (dir lock held)."""
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            return
+        archive = os.path.join(METRICS['multiproc_dir'], 'archive.json')
+        combined = self._combine([_read_json(archive)] + [_read_json(path) for path in paths])
+        _write_json(archive, {name: [[list(key), value] for key, value in values.items()]
+                              for name, values in combined.items()})
+        for path in paths:
+            os.remove(path)
+
+    @contextlib.contextmanager
+    def _dir_lock(self):
+        # POSIX only, like multiprocess mode itself: imported here so the app
+        # still imports on Windows without METRICS['multiproc_dir']
+        import fcntl
+
+        with open(os.path.join(METRICS['multiproc_dir'], '.lock'), 'a') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _path(self, pid):
+        return os.path.join(METRICS['multiproc_dir'], f'metrics-{pid}.json')
+
+
+def _alive(path):
+    pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_json(path):
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path, data):
+    # write-then-rename: a scrape never reads half a file
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as handle:
+        json.dump(data, handle)
+    os.replace(tmp, path)
+
+
+registry = Registry()
+
+HTTP_LATENCY = registry.register(Histogram(
+    'codice_http_request_duration_seconds', 'HTTP request latency by route.',
+    labels=('method', 'route', 'status'),
+))
+CREATE_VM_PHASE = registry.register(Histogram(
+    'codice_create_vm_phase_duration_seconds', 'Duration of the phases of a VM creation.',
+    labels=('phase',), buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+))
+PROXMOX_LATENCY = registry.register(Histogram(
+    'codice_proxmox_request_duration_seconds', 'Proxmox API call latency by endpoint.',
+    labels=('method', 'endpoint'), buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+))
+PROXMOX_ERRORS = registry.register(Counter(
+    'codice_proxmox_request_errors_total', 'Proxmox API calls answered with an HTTP error.',
+    labels=('method', 'endpoint', 'status'),
+))
+VM_REQUESTS = registry.register(Gauge(
+    'codice_vm_requests', 'VM requests waiting for approval or being provisioned.',
+    labels=('status',),
+))
+RATE_LIMITED = registry.register(Counter(
+    'codice_rate_limited_total', 'Hits refused by a rate limit rule.',
+    labels=('rule',),
+))
+DB_POOL = registry.register(Gauge(
+    'codice_db_pool_connections', 'SQLAlchemy connection pool usage.',
+    labels=('state',),
+))
+
+
+def init_app(app):
+    """Time every request into HTTP_LATENCY (served at /metrics, see routes/metrics.py)."""
+    if not METRICS.get('enabled', True):
+        return
+    registry.start_flushing()
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_latency(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            # the URL rule, not the path, keeps the label set bounded
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_LATENCY.observe(time.perf_counter() - started,
+                                 method=request.method, route=route, status=response.status_code)
+        return response
@@ -0,0 +1,69 @@
+import base64
+import binascii
+import datetime
+import json
+
+import sqlalchemy as sa
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row of a page as an opaque URL-safe string."""
+    plain = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(plain).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Decode a cursor made by encode_cursor; raise ValueError if it is malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('invalid cursor') from e
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('invalid cursor')
+    return [_decode_value(column, value) for column, value in zip(columns, values)]
+
+
+def _decode_value(column, value):
+    # the values go straight into SQL: only scalars of the column's type
+    if value is None:
+        return None
+    if isinstance(column.type, sa.DateTime):
+        if not isinstance(value, str):
+            raise ValueError('invalid cursor')
+        return datetime.datetime.fromisoformat(value)
+    try:
+        expected = column.type.python_type
+    except NotImplementedError:
+        expected = (str, int, float)
+    if isinstance(value, bool) or not isinstance(value, expected):
+        raise ValueError('invalid cursor')
+    return value
+
+
+def keyset_paginate(session, stmt, columns, cursor=None, limit=50, descending=True, scalars=True):
+    """Return (rows, next_cursor) for one page of ``stmt`` ordered by ``columns``.
+
+    Seeks past the row identified by ``cursor`` with a WHERE on the sort key
+    instead of OFFSET, so every page costs the same however deep it is. The
+    last column must be unique (usually the primary key). With
+    ``scalars=False`` plain rows are returned; they must include ``columns``.
+    """
+    if cursor:
+        values = decode_cursor(cursor, columns)
+        # (c1, c2, ...) < (v1, v2, ...) spelled out for backends without row values
+        clauses = []
+        for i, column in enumerate(columns):
+            equal = [columns[j] == values[j] for j in range(i)]
+            beyond = column < values[i] if descending else column > values[i]
+            clauses.append(sa.and_(*equal, beyond))
+        stmt = stmt.where(sa.or_(*clauses))
+    order = [c.desc() if descending else c.asc() for c in columns]
+    result = session.execute(stmt.order_by(*order).limit(limit + 1))
+    rows = result.scalars().all() if scalars else result.all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, c.key) for c in columns])
+    return rows, next_cursor
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+
+from flask import request
+
+from config import RATE_LIMIT
+from utils.metrics import RATE_LIMITED
+
+LOG = logging.getLogger(__name__)
+
+# atomic token bucket: KEYS[1] bucket, ARGV rate, burst, cost, now; returns the seconds to wait
+_REDIS_BUCKET = """
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(state[1]) or burst
+local at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class MemoryStore:
+    """Token buckets and coalescing marks of this process only."""
+
+    def __init__(self, max_keys=100000):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._marks = {}
+        self._max_keys = max_keys
+
+    def take(self, keys, rate, burst, cost=1):
+        """Take ``cost`` tokens from each bucket; return the seconds to wait per key (0 = allowed)."""
+        now = time.monotonic()
+        waits = []
+        with self._lock:
+            if len(self._buckets) > self._max_keys:
+                self._prune(now)
+            for key in keys:
+                tokens, at, _ = self._buckets.get(key, (burst, now, now))
+                tokens = min(burst, tokens + (now - at) * rate)
+                if tokens >= cost:
+                    tokens -= cost
+                    waits.append(0)
+                else:
+                    waits.append((cost - tokens) / rate)
+                # the third item is when the bucket will be full again
+                self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        return waits
+
+    def recent(self, keys):
+        """{key: value} of the coalescing marks still valid among ``keys``."""
+        now = time.monotonic()
+        with self._lock:
+            found = {}
+            for key in keys:
+                mark = self._marks.get(key)
+                if mark is not None and mark[1] > now:
+                    found[key] = mark[0]
+            return found
+
+    def remember(self, marks, ttl):
+        expires = time.monotonic() + ttl
+        with self._lock:
+            if len(self._marks) > self._max_keys:
+                now = time.monotonic()
+                self._marks = {k: v for k, v in self._marks.items() if v[1] > now}
+            for key, value in marks.items():
+                self._marks[key] = (value, expires)
+
+    def _prune(self, now):
+        # a bucket full again is the same as no bucket
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+
+
+class RedisStore:
+    """Buckets and marks shared by every worker through Redis (RATE_LIMIT['redis_url'])."""
+
+    def __init__(self, url):
+        import redis
+
+        self._redis = redis.Redis.from_url(url, socket_timeout=1)
+        self._bucket = self._redis.register_script(_REDIS_BUCKET)
+        self._prefix = RATE_LIMIT.get('redis_prefix', 'codice:rl:')
+
+    def take(self, keys, rate, burst, cost=1):
+        now = time.time()
+        pipe = self._redis.pipeline(transaction=False)
+        for key in keys:
+            self._bucket(keys=[self._prefix + key], args=[rate, burst, cost, now], client=pipe)
+        return [float(wait) for wait in pipe.execute()]
+
+    def recent(self, keys):
+        if not keys:
+            return {}
+        values = self._redis.mget([self._prefix + 'c:' + key for key in keys])
+        return {key: value.decode() for key, value in zip(keys, values) if value is not None}
+
+    def remember(self, marks, ttl):
+        pipe = self._redis.pipeline(transaction=False)
+        for key, value in marks.items():
+            pipe.set(self._prefix + 'c:' + key, value, ex=max(1, int(ttl)))
+        pipe.execute()
+
+
+class RateLimiter:
+    """Token-bucket rate limits and duplicate-report coalescing.
+
+    Each rule in RATE_LIMIT['rules'] is a bucket of ``burst`` tokens refilled
+    at ``rate`` tokens per second, one bucket per key (client IP, vmid,
+    account...). Keys in the rule's ``exempt`` list are never limited.
+    Buckets live in process memory, or in Redis when RATE_LIMIT['redis_url']
+    is set so the limit holds across gunicorn workers. If Redis is
+    unreachable requests are let through rather than refused.
+    """
+
+    def __init__(self, app=None):
+        self.store = MemoryStore()
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def enabled(self):
+        return RATE_LIMIT.get('enabled', True)
+
+    def init_app(self, app):
+        app.extensions['ratelimit'] = self
+        url = RATE_LIMIT.get('redis_url')
+        if url:
+            try:
+                self.store = RedisStore(url)
+            except ImportError:
+                LOG.warning('RATE_LIMIT redis_url is set but the redis package is not installed; '
+                            'using per-process limits')
+
+    def hit(self, rule, key, cost=1):
+        """Count one hit of ``key`` against ``rule``; return the seconds to wait (0 = allowed)."""
+        return self.hit_many(rule, [key], cost)[0]
+
+    def hit_many(self, rule, keys, cost=1):
+        if not self.enabled or not keys:
+            return [0] * len(keys)
+        cfg = RATE_LIMIT['rules'][rule]
+        exempt = {str(key) for key in cfg.get('exempt', ())}
+        limited_keys = [key for key in keys if str(key) not in exempt]
+        if not limited_keys:
+            return [0] * len(keys)
+        try:
+            taken = self.store.take([f'{rule}:{key}' for key in limited_keys], cfg['rate'], cfg['burst'], cost)
+        except Exception:
+            LOG.exception('Rate limit store unavailable, not limiting %s', rule)
+            return [0] * len(keys)
+        taken = iter(taken)
+        waits = [0 if str(key) in exempt else next(taken) for key in keys]
+        limited = sum(1 for wait in waits if wait)
+        if limited:
+            RATE_LIMITED.inc(limited, rule=rule)
+        return waits
+
+    def recent(self, namespace, keys):
+        """{key: value} reported for ``keys`` within the coalescing window."""
+        try:
+            found = self.store.recent([f'{namespace}:{key}' for key in keys])
+        except Exception:
+            LOG.exception('Rate limit store unavailable, not coalescing %s', namespace)
+            return {}
+        prefix = len(namespace) + 1
+        return {key[prefix:]: value for key, value in found.items()}
+
+    def remember(self, namespace, marks):
+        """Record ``marks`` ({key: value}) for RATE_LIMIT['coalesce_window'] seconds."""
+        try:
+            self.store.remember({f'{namespace}:{key}': value for key, value in marks.items()},
+                                RATE_LIMIT.get('coalesce_window', 30))
+        except Exception:
+            LOG.exception('Rate limit store unavailable, not coalescing %s', namespace)
+
+
+def client_ip():
+    """Address of the client; the first X-Forwarded-For hop only behind a trusted proxy."""
+    if RATE_LIMIT.get('behind_proxy') and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or 'unknown'
+
+
+limiter = RateLimiter()
@@ -1,3 +1,4 @@
+import ipaddress
 import re
 
 
@@ -27,3 +28,34 @@ def sanitize_vm_name(name: str, max_length: int = 63) -> str:
         s = s[:max_length]
         s = s.rstrip('-')
     return s
+
+
+def normalize_ips(value, max_addresses: int = 8, max_length: int = 255) -> str:
+    """Validate one or more IPv4/IPv6 addresses and return them comma-separated.
+
+    ``value`` may be a single address, a comma/space separated string or a list.
+    Raises ValueError if any address is invalid, there are too many or the
+    result is longer than ``max_length`` (the size of ``VMRequest.IP``).
+    """
+    if isinstance(value, str):
+        parts = re.split(r'[\s,]+', value.strip())
+    elif isinstance(value, (list, tuple)):
+        parts = [str(v).strip() for v in value]
+    else:
+        raise ValueError('ip must be a string or a list of strings')
+    addresses = []
+    for part in parts:
+        if not part:
+            continue
+        # drop an optional prefix length (e.g. "10.0.0.5/24" from the guest agent)
+        addr = str(ipaddress.ip_address(part.split('/')[0]))
+        if addr not in addresses:
+            addresses.append(addr)
+    if not addresses:
+        raise ValueError('no ip address given')
+    if len(addresses) > max_addresses:
+        raise ValueError(f'at most {max_addresses} addresses per VM')
+    joined = ','.join(addresses)
+    if len(joined) > max_length:
+        raise ValueError(f'addresses longer than {max_length} characters')
+    return joined
@@ -0,0 +1,11 @@
+# Entry point for production servers, e.g.:
+#   gunicorn -c gunicorn.conf.py wsgi:application
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import create_app, start_services  # noqa: E402
+
+application = create_app({'ENABLE_MIGRATIONS': False})
+# start workers/sync now instead of waiting for the first request
+start_services(application)